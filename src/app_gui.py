@@ -6,8 +6,15 @@ from tkinter import filedialog, messagebox
 from PIL import Image, ImageTk
 from database import Database
 from scanner import PhotoScanner
-from face_engine import FaceEngine
-from config import FACE_DISTANCE_THRESHOLD, RESULTS_DIR
+from face_engine import FaceEngine, encode_crop
+from reembed import ModelMigration
+from person_index import PersonIndex
+from progress import ProgressChannel
+from search import search_faces, parse_date_bound, SearchCache
+from config import (
+    FACE_DISTANCE_THRESHOLD, RESULTS_DIR, SEARCH_MIN_DET_SCORE, SEARCH_MIN_FACE_SIZE, SEARCH_MAX_THRESHOLD,
+    PROGRESS_REFRESH_MS,
+)
 
 ctk.set_appearance_mode("dark")
 ctk.set_default_color_theme("blue")
@@ -37,6 +44,13 @@ class App(ctk.CTk):
         self.db = Database()
         self.engine = FaceEngine()
         self.scanner = PhotoScanner(self.db)
+        self.db.init_model_version(self.engine.model_version)
+        self.migration = ModelMigration(self.db, self.engine)
+        self.person_index = PersonIndex(self.db, self.engine)
+        self.search_cache = SearchCache()
+        self._search_result = None
+        self._render_job = None
+        self._migrating = False
         self._state = STATE_IDLE
 
         self._build_ui()
@@ -44,6 +58,9 @@ class App(ctk.CTk):
         self._load_persons()
         self._refresh_stats()
 
+        if self.migration.needed:
+            self._start_migration()
+
     # ==================================================================
     #  UI CONSTRUCTION
     # ==================================================================
@@ -123,6 +140,11 @@ class App(ctk.CTk):
         )
         # Not packed yet — only visible during scan
 
+        self.btn_pause = ctk.CTkButton(
+            self.sidebar, text="⏸  Pause", command=self._toggle_pause, height=32
+        )
+        # Not packed yet — only visible during scan
+
         # Separator
         sep1 = ctk.CTkFrame(self.sidebar, height=2, fg_color="#333333")
         sep1.pack(fill="x", padx=15, pady=12)
@@ -141,6 +163,41 @@ class App(ctk.CTk):
         )
         self.person_dropdown.pack(fill="x", padx=15, pady=(0, 5))
 
+        # Optional search filters
+        dates = ctk.CTkFrame(self.sidebar, fg_color="transparent")
+        dates.pack(fill="x", padx=15, pady=(0, 5))
+        self.taken_from_entry = ctk.CTkEntry(
+            dates, placeholder_text="From YYYY-MM-DD", height=28, font=ctk.CTkFont(size=11)
+        )
+        self.taken_from_entry.pack(side="left", expand=True, fill="x", padx=(0, 3))
+        self.taken_to_entry = ctk.CTkEntry(
+            dates, placeholder_text="To YYYY-MM-DD", height=28, font=ctk.CTkFont(size=11)
+        )
+        self.taken_to_entry.pack(side="left", expand=True, fill="x", padx=(3, 0))
+
+        self.folder_entry = ctk.CTkEntry(
+            self.sidebar, placeholder_text="Only under folder...", height=28, font=ctk.CTkFont(size=11)
+        )
+        self.folder_entry.pack(fill="x", padx=15, pady=(0, 5))
+
+        # Match threshold; moving it re-filters the current results
+        self.threshold_label = ctk.CTkLabel(
+            self.sidebar,
+            text=f"Match threshold: {FACE_DISTANCE_THRESHOLD:.2f}",
+            font=ctk.CTkFont(size=11),
+            anchor="w",
+        )
+        self.threshold_label.pack(fill="x", padx=15)
+        self.threshold_slider = ctk.CTkSlider(
+            self.sidebar,
+            from_=0.6,
+            to=SEARCH_MAX_THRESHOLD,
+            number_of_steps=round((SEARCH_MAX_THRESHOLD - 0.6) * 100),
+            command=self._on_threshold_change,
+        )
+        self.threshold_slider.set(FACE_DISTANCE_THRESHOLD)
+        self.threshold_slider.pack(fill="x", padx=15, pady=(0, 5))
+
         self.btn_search = ctk.CTkButton(
             self.sidebar,
             text="🔍  Search",
@@ -156,6 +213,17 @@ class App(ctk.CTk):
         )
         self.btn_register.pack(fill="x", padx=15, pady=2)
 
+        # Co-occurrence query, e.g. "Alice & Bob" or "Alice & !Bob"
+        self.query_entry = ctk.CTkEntry(
+            self.sidebar, placeholder_text="Alice & Bob, Alice & !Bob", height=28, font=ctk.CTkFont(size=11)
+        )
+        self.query_entry.pack(fill="x", padx=15, pady=(8, 2))
+
+        self.btn_query = ctk.CTkButton(
+            self.sidebar, text="👥  Find Together", command=self.query_persons, height=32
+        )
+        self.btn_query.pack(fill="x", padx=15, pady=2)
+
         # Separator
         sep2 = ctk.CTkFrame(self.sidebar, height=2, fg_color="#333333")
         sep2.pack(fill="x", padx=15, pady=12)
@@ -277,10 +345,13 @@ class App(ctk.CTk):
             self.btn_rescan.configure(state="disabled")
             self.btn_search.configure(state="disabled")
             self.btn_register.configure(state="disabled")
+            self.btn_query.configure(state="disabled")
             self.person_dropdown.configure(state="disabled")
-            # Show cancel button
+            # Show pause and cancel buttons
             self.btn_rescan.pack_forget()
             self.btn_cancel.pack(fill="x", padx=15, pady=2, after=self.btn_select)
+            self.btn_pause.configure(state="normal", text="⏸  Pause")
+            self.btn_pause.pack(fill="x", padx=15, pady=2, after=self.btn_cancel)
             # Show progress, hide output
             self.output_frame.pack_forget()
             self.progress_frame.pack(expand=True, fill="both", padx=10, pady=10)
@@ -289,6 +360,7 @@ class App(ctk.CTk):
             self.btn_rescan.configure(state="disabled")
             self.btn_search.configure(state="disabled")
             self.btn_register.configure(state="disabled")
+            self.btn_query.configure(state="disabled")
             self.person_dropdown.configure(state="disabled")
             # Clear output for new search
             self.output_header.configure(text="Searching...")
@@ -299,8 +371,10 @@ class App(ctk.CTk):
             self.btn_rescan.configure(state="normal")
             self.btn_search.configure(state="normal")
             self.btn_register.configure(state="normal")
+            self.btn_query.configure(state="normal")
             self.person_dropdown.configure(state="normal")
-            # Hide cancel, show rescan
+            # Hide pause and cancel, show rescan
+            self.btn_pause.pack_forget()
             self.btn_cancel.pack_forget()
             self.btn_rescan.pack(fill="x", padx=15, pady=2, after=self.btn_select)
             # Hide progress, show output
@@ -355,14 +429,13 @@ class App(ctk.CTk):
         self.progress_detail.configure(text="Listing files...")
         self.progress_file.configure(text="")
         self._scan_start_time = time.time()
-        self._scan_timestamps = []  # timestamps for ETA moving average
+        # The scanner reports every photo; the display polls it at a fixed rate
+        progress = ProgressChannel()
 
         def task():
-            def progress(processed, total, errors, current_file):
-                self._ui(lambda p=processed, t=total, e=errors, f=current_file:
-                         self._update_progress(p, t, e, f))
-
-            stats = self.scanner.scan(root_path, progress)
+            stats = self.scanner.scan(root_path, progress.update)
+            self._set_status("Updating person index...")
+            self.person_index.refresh()
 
             def on_done():
                 self._set_state(STATE_IDLE)
@@ -372,41 +445,45 @@ class App(ctk.CTk):
             self._ui(on_done)
 
         threading.Thread(target=task, daemon=True).start()
+        self.after(PROGRESS_REFRESH_MS, self._poll_progress, progress)
 
-    def _update_progress(self, processed, total, errors, current_file):
+    def _poll_progress(self, progress):
+        """Redraw the scan progress until the scan is over."""
+        if self._state != STATE_SCANNING:
+            return
+        snapshot = progress.snapshot()
+        if snapshot is not None:
+            self._update_progress(snapshot)
+        self.after(PROGRESS_REFRESH_MS, self._poll_progress, progress)
+
+    def _update_progress(self, snapshot):
         """Update the progress bar and details. Called on the main thread."""
+        processed, total, errors = snapshot.processed, snapshot.total, snapshot.errors
         if total == 0:
             return
 
         pct = processed / total
         self.progress_bar.set(pct)
 
-        now = time.time()
-        self._scan_timestamps.append(now)
-
-        # ETA with moving average (last 100 photos)
-        window = 100
-        if len(self._scan_timestamps) >= 2:
-            ts = self._scan_timestamps[-window:]
-            window_elapsed = ts[-1] - ts[0]
-            window_count = len(ts) - 1
-            per_item = window_elapsed / window_count
-            remaining = per_item * (total - processed)
-            eta = self._format_time(remaining)
-        else:
-            eta = "calculating..."
-
+        eta = self._format_time(snapshot.eta) if snapshot.eta is not None else "calculating..."
         err_text = f"  •  ⚠ {errors} errors" if errors else ""
         self.progress_detail.configure(
-            text=f"{processed:,}/{total:,} photos  ({pct:.0%}){err_text}  •  Time remaining: {eta}"
+            text=f"{processed:,}/{total:,} photos  ({pct:.0%}){err_text}  •  "
+                 f"{snapshot.rate:.1f} photos/s  •  Time remaining: {eta}"
         )
 
         # Show short name of current file
-        short = os.path.basename(current_file) if current_file else ""
+        short = os.path.basename(snapshot.current_file) if snapshot.current_file else ""
         self.progress_file.configure(text=short)
 
-        self.progress_title.configure(text="Scanning photos...")
-        self._set_status(f"Scanning {processed:,}/{total:,}")
+        if self.scanner.is_cancelled or processed >= total:
+            return  # Title and status now belong to the cancel or wrap-up
+        if self.scanner.is_paused:
+            self.progress_title.configure(text="Paused")
+            self.status_label.configure(text=f"Paused at {processed:,}/{total:,}")
+        else:
+            self.progress_title.configure(text="Scanning photos...")
+            self.status_label.configure(text=f"Scanning {processed:,}/{total:,}")
 
     def _show_scan_summary(self, stats):
         """Show scan summary in the main area."""
@@ -419,9 +496,19 @@ class App(ctk.CTk):
         if stats.get("cancelled"):
             self.output_box.insert("end", "  ⚠ Scan cancelled by user.\n\n")
             self._set_status("Cancelled")
+        elif stats.get("unavailable"):
+            self.output_box.insert(
+                "end",
+                "  ⚠ No photos found, but this library has indexed photos.\n"
+                "    The drive may not be mounted; the index was left untouched.\n\n",
+            )
+            self._set_status("Drive not mounted?")
         else:
             self._set_status("Ready")
 
+        if stats.get("relocated"):
+            self.output_box.insert("end", f"  🔗 Library relocated from: {stats['relocated']}\n\n")
+
         self.output_box.insert("end", f"  Total time: {time_str}\n\n")
         self.output_box.insert("end", f"  📷 New photos processed:  {stats.get('new', 0)}\n")
         self.output_box.insert("end", f"  😀 Faces found:           {stats.get('faces_found', 0)} (in {stats.get('photos_with_faces', 0)} photos)\n")
@@ -431,11 +518,34 @@ class App(ctk.CTk):
         if stats.get("errors", 0) > 0:
             self.output_box.insert("end", f"  ⚠  Errors (photos skipped): {stats['errors']}\n")
 
+        coarse = stats.get("coarse")
+        if coarse and coarse["checked"]:
+            self.output_box.insert(
+                "end",
+                f"\n  ⚡ Thumbnail pre-check: {coarse['skipped']:,} of {coarse['checked']:,} photos "
+                f"skipped without a full decode ({coarse['from_exif']:,} via EXIF thumbnail)\n"
+                f"     Estimated time saved: {self._format_time(coarse['saved_time'])}\n",
+            )
+
     def _cancel_scan(self):
         self.scanner.cancel()
         self.progress_title.configure(text="Cancelling...")
         self.progress_detail.configure(text="Waiting for in-progress tasks to finish...")
         self.btn_cancel.configure(state="disabled")
+        self.btn_pause.configure(state="disabled")
+
+    def _toggle_pause(self):
+        """Pause the scan after the photos in progress, or resume it."""
+        if self.scanner.is_paused:
+            self.scanner.resume()
+            self.btn_pause.configure(text="⏸  Pause")
+            self.progress_title.configure(text="Scanning photos...")
+            self._set_status("Scanning...")
+        else:
+            self.scanner.pause()
+            self.btn_pause.configure(text="▶  Resume")
+            self.progress_title.configure(text="Paused")
+            self._set_status("Paused")
 
     @staticmethod
     def _format_time(seconds):
@@ -449,8 +559,55 @@ class App(ctk.CTk):
         hours, mins = divmod(minutes, 60)
         return f"{hours}h {mins:02d}m {secs:02d}s"
 
+    # -- Model migration --
+    def _start_migration(self):
+        """Re-embed stored face crops with the new recognition model.
+
+        Runs in the background; searches use the previous embeddings until
+        it finishes.
+        """
+        self._migrating = True
+        self._set_status("Updating face index for the new model...")
+
+        def task():
+            def progress(done, total):
+                self._set_status(f"Updating face index: {done:,}/{total:,}")
+
+            stats = self.migration.run(progress)
+            if not stats["cancelled"]:
+                self.person_index.refresh()
+
+            def on_done():
+                self._migrating = False
+                self._refresh_stats()
+                self._set_status("Ready")
+                lines = [f"Face index updated for the new recognition model ({stats['faces']:,} faces)."]
+                if stats["stale_photos"]:
+                    lines.append(
+                        f"{stats['stale_photos']:,} photos had no stored face crops and will be "
+                        "processed again on the next scan."
+                    )
+                if stats["persons_without_crops"]:
+                    lines.append(
+                        f"{stats['persons_without_crops']} persons were registered with an older "
+                        "version and need to be registered again."
+                    )
+                messagebox.showinfo("Model updated", "\n\n".join(lines))
+
+            self._ui(on_done)
+
+        threading.Thread(target=task, daemon=True).start()
+
     # -- Person Registration --
     def register_person(self):
+        if self._migrating:
+            messagebox.showinfo(
+                "Please wait",
+                "The face index is being updated for a new recognition model.\n"
+                "Registration will be available when it finishes.",
+            )
+            return
+
         name = ctk.CTkInputDialog(text="Person's name:", title="Register Person").get_input()
         if not name or not name.strip():
             return
@@ -466,22 +623,25 @@ class App(ctk.CTk):
 
         self._set_status("Detecting face...")
 
-        embeddings = self.engine.extract_embeddings(image_path)
-        if len(embeddings) == 0:
+        faces = self.engine.extract_faces(image_path)
+        if len(faces) == 0:
             messagebox.showerror("Error", "No face detected in the image.")
             self._set_status("Ready")
             return
-        if len(embeddings) > 1:
+        if len(faces) > 1:
             messagebox.showerror(
                 "Error",
-                f"{len(embeddings)} faces detected.\n"
+                f"{len(faces)} faces detected.\n"
                 "The image must contain exactly 1 face.",
             )
             self._set_status("Ready")
             return
 
         try:
-            self.db.add_person(name, embeddings[0])
+            self.db.add_person(
+                name, faces[0].embedding,
+                crop=encode_crop(faces[0].crop), model_version=self.engine.model_version,
+            )
         except Exception as e:
             if "UNIQUE" in str(e):
                 messagebox.showerror("Error", f"A person named '{name}' already exists.")
@@ -492,6 +652,8 @@ class App(ctk.CTk):
 
         self._load_persons()
         self._refresh_stats()
+        # Find the new person's photos in the background for co-occurrence queries
+        threading.Thread(target=self.person_index.refresh, daemon=True).start()
         messagebox.showinfo("Success", f"Person '{name}' registered successfully!")
         self._set_status("Ready")
 
@@ -502,10 +664,21 @@ class App(ctk.CTk):
             messagebox.showwarning("Warning", "Please select a person from the dropdown.")
             return
 
+        try:
+            filters = dict(
+                taken_from=parse_date_bound(self.taken_from_entry.get()),
+                taken_to=parse_date_bound(self.taken_to_entry.get()),
+                folder=self.folder_entry.get().strip() or None,
+            )
+        except ValueError as e:
+            messagebox.showwarning("Warning", str(e))
+            return
+
         self._set_state(STATE_SEARCHING)
         self._set_status("Searching...")
 
         person_id = self.person_map[name]
+        threshold = self.threshold_slider.get()
 
         def task():
             query_embedding = self.db.get_person_embedding(person_id)
@@ -518,9 +691,28 @@ class App(ctk.CTk):
                 self._ui(on_error)
                 return
 
-            db_embeddings, paths = self.db.get_all_face_embeddings()
+            if self.db.get_person_model_version(person_id) != self.db.model_version:
+                def on_outdated():
+                    messagebox.showerror(
+                        "Error",
+                        f"'{name}' was registered with a different recognition model.\n"
+                        "Please register this person again.",
+                    )
+                    self._set_state(STATE_IDLE)
+                    self._set_status("Ready")
+                self._ui(on_outdated)
+                return
 
-            if len(db_embeddings) == 0:
+            # Checked before anything reads the faces table. Results stay
+            # valid until the next scan or model migration
+            key = (person_id, self.db.get_index_generation(), self.db.model_version,
+                   tuple(sorted(filters.items())))
+            result = self.search_cache.get(key)
+            if result is not None:
+                self._ui(lambda: self._show_search_result(name, result))
+                return
+
+            if not self.db.has_faces(min_det_score=SEARCH_MIN_DET_SCORE, min_face_size=SEARCH_MIN_FACE_SIZE):
                 def on_empty():
                     messagebox.showinfo("Info", "No photos indexed. Please run a scan first.")
                     self._set_state(STATE_IDLE)
@@ -528,40 +720,108 @@ class App(ctk.CTk):
                 self._ui(on_empty)
                 return
 
-            distances = self.engine.compare(query_embedding, db_embeddings)
+            # Matches are listed as each chunk of the index is scored; the
+            # final sorted list replaces them when the search completes
+            found = set()
 
-            # Collect unique results, keeping the smallest distance per photo
-            photo_best_dist = {}
-            for i, d in enumerate(distances):
-                if d < FACE_DISTANCE_THRESHOLD:
-                    path = paths[i]
-                    if path not in photo_best_dist or d < photo_best_dist[path]:
-                        photo_best_dist[path] = d
+            def progress(updated, scanned, total):
+                new = {
+                    path: dist for path, dist in updated.items()
+                    if path not in found and dist < threshold
+                }
+                found.update(new)
+                count = len(found)
 
-            # Sort by proximity (smaller distance = more similar)
-            results = sorted(photo_best_dist.keys(), key=lambda p: photo_best_dist[p])
+                def show():
+                    for path, dist in new.items():
+                        self.output_box.insert("end", f"  [{dist:.3f}]  {path}\n")
+                    self.output_header.configure(text=f"Searching '{name}' — {count} photos found so far")
+                    self.status_label.configure(text=f"Searching... {scanned / total:.0%}")
+                self._ui(show)
+
+            # Everything up to the slider's maximum is kept for re-filtering
+            result = search_faces(
+                self.db, self.engine, query_embedding, threshold=SEARCH_MAX_THRESHOLD,
+                on_progress=progress, **filters
+            )
+            self.search_cache.put(key, result)
+            self._ui(lambda: self._show_search_result(name, result))
 
-            def on_done():
-                self._search_results = results
-                self._search_distances = photo_best_dist
-                self._search_person = name
-                self._set_state(STATE_RESULTS)
+        threading.Thread(target=task, daemon=True).start()
 
-                self.output_header.configure(
-                    text=f"Results for '{name}' — {len(self._search_results)} photos found"
-                )
-                self.output_box.delete("1.0", "end")
+    def _show_search_result(self, name, result):
+        self._search_result = result
+        self._search_person = name
+        self._set_state(STATE_RESULTS)
+        self._render_search_result()
+
+    def _render_search_result(self):
+        """List the photos of the current result within the slider threshold."""
+        self._render_job = None
+        result = self._search_result
+        if result is None or self._state != STATE_RESULTS:
+            return
 
-                if self._search_results:
-                    for path in self._search_results:
-                        dist = photo_best_dist[path]
-                        self.output_box.insert("end", f"  [{dist:.3f}]  {path}\n")
-                    self.btn_symlinks.pack(fill="x", pady=(10, 0))
-                else:
-                    self.output_box.insert("end", "  No photos found for this person.\n")
-                    self.btn_symlinks.pack_forget()
+        distances, photo_ids = result.within(self.threshold_slider.get())
+        paths = self.db.get_photo_paths(photo_ids)
+        self._search_results = [paths[i] for i in photo_ids.tolist() if i in paths]
+        self._search_distances = {paths[i]: float(d) for i, d in zip(photo_ids.tolist(), distances) if i in paths}
+        name = self._search_person
 
-                self._set_status(f"Found {len(self._search_results)} photos")
+        self.output_header.configure(
+            text=f"Results for '{name}' — {len(self._search_results)} photos found"
+        )
+        self.output_box.delete("1.0", "end")
+
+        if self._search_results:
+            lines = (f"  [{self._search_distances[path]:.3f}]  {path}\n" for path in self._search_results)
+            self.output_box.insert("end", "".join(lines))
+            self.btn_symlinks.pack(fill="x", pady=(10, 0))
+        else:
+            self.output_box.insert("end", "  No photos found for this person.\n")
+            self.btn_symlinks.pack_forget()
+
+        self._set_status(f"Found {len(self._search_results)} photos")
+
+    def _on_threshold_change(self, value):
+        self.threshold_label.configure(text=f"Match threshold: {value:.2f}")
+        # Coalesce slider motion into one re-render
+        if self._render_job is not None:
+            self.after_cancel(self._render_job)
+        self._render_job = self.after(30, self._render_search_result)
+
+    # -- Co-occurrence --
+    def query_persons(self):
+        expression = self.query_entry.get().strip()
+        if not expression:
+            messagebox.showwarning("Warning", "Enter a query such as 'Alice & Bob' or 'Alice & !Bob'.")
+            return
+
+        self._set_state(STATE_SEARCHING)
+        self._set_status("Searching...")
+        person_ids = dict(self.person_map)
+
+        def task():
+            try:
+                paths = self.person_index.query(expression, person_ids)
+            except ValueError as e:
+                def on_error(message=str(e)):
+                    messagebox.showerror("Error", message)
+                    self._set_state(STATE_IDLE)
+                    self._set_status("Ready")
+                self._ui(on_error)
+                return
+
+            def on_done():
+                self._search_result = None
+                self._set_state(STATE_RESULTS)
+                self.output_header.configure(text=f"Results for '{expression}' — {len(paths)} photos found")
+                self.output_box.delete("1.0", "end")
+                for path in paths:
+                    self.output_box.insert("end", f"  {path}\n")
+                if not paths:
+                    self.output_box.insert("end", "  No photos match this query.\n")
+                self._set_status(f"Found {len(paths)} photos")
 
             self._ui(on_done)
 
@@ -0,0 +1,116 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
+from config import MAX_WORKERS, RECOGNITION_BATCH_SIZE, RECOGNITION_FLUSH_TIMEOUT
+
+_STOP = object()
+
+
+class RecognitionBatcher:
+    """Runs recognition on aligned face crops collected from many images.
+
+    Scanner threads submit the crops of one image and get a Future back.
+    A collector thread packs pending crops into batches of `batch_size`
+    and hands each batch to one of `workers` threads, which runs it
+    through the model in one call. Sessions run few threads each (see
+    face_engine.py), so batches run side by side to use the cores. A
+    partial batch is flushed `flush_timeout` seconds after its first crop
+    arrived, so latency stays bounded when few faces are coming in.
+
+    With a `governor` (see governor.py), each batch runs in one of its CPU
+    slots, so recognition counts against the scan's CPU budget. Batches
+    still run after a cancel, so the faces of photos in flight are stored.
+    """
+
+    def __init__(self, engine, batch_size=RECOGNITION_BATCH_SIZE, flush_timeout=RECOGNITION_FLUSH_TIMEOUT,
+                 governor=None, workers=MAX_WORKERS):
+        self.engine = engine
+        self.governor = governor
+        self.batch_size = max(1, batch_size)
+        self.flush_timeout = flush_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.stats = {"batches": 0, "crops": 0, "inference_time": 0.0}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, crops):
+        """Queue the crops of one image.
+
+        Returns a Future resolving to an (N, 512) array of embeddings in
+        the same order as `crops`.
+        """
+        future = Future()
+        if len(crops) == 0:
+            future.set_result(self.engine.embed_crops([]))
+            return future
+        self._queue.put((future, list(crops)))
+        return future
+
+    def close(self):
+        """Flush what is pending and stop the worker threads."""
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def _run(self):
+        pending = []  # (future, crops)
+        pending_crops = 0
+        deadline = None
+
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._executor.submit(self._flush, pending)
+                return
+
+            if item is not None:
+                pending.append(item)
+                pending_crops += len(item[1])
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_timeout
+
+            if pending_crops >= self.batch_size or (deadline is not None and time.monotonic() >= deadline):
+                self._executor.submit(self._flush, pending)
+                pending = []
+                pending_crops = 0
+                deadline = None
+
+    def _flush(self, pending):
+        if not pending:
+            return
+
+        crops = [crop for _, item_crops in pending for crop in item_crops]
+        try:
+            start = time.perf_counter()
+            chunks = []
+            for i in range(0, len(crops), self.batch_size):
+                with self.governor.slot(cancellable=False) if self.governor else nullcontext():
+                    chunks.append(self.engine.embed_crops(crops[i:i + self.batch_size]))
+            elapsed = time.perf_counter() - start
+        except Exception as e:
+            for future, _ in pending:
+                future.set_exception(e)
+            return
+
+        with self._stats_lock:
+            self.stats["batches"] += len(chunks)
+            self.stats["crops"] += len(crops)
+            self.stats["inference_time"] += elapsed
+
+        embeddings = np.concatenate(chunks, axis=0)
+        offset = 0
+        for future, item_crops in pending:
+            future.set_result(embeddings[offset:offset + len(item_crops)])
+            offset += len(item_crops)
+
@@ -0,0 +1,99 @@
+"""Benchmark per-image vs cross-image batched recognition inference.
+
+Usage:
+    python src/benchmark_recognition.py <photo_dir> [max_photos]
+
+Detects and aligns the faces of up to `max_photos` photos once, then times
+the recognition model on the same crops: one call per photo, on one thread
+and on MAX_WORKERS threads (what a scan did before batching), fixed-size
+batches across photos, and the scanner's batcher with its workers. The
+sessions use the same thread limit as a scan (ONNX_THREADS).
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from batching import RecognitionBatcher
+from config import VALID_EXTENSIONS, RECOGNITION_BATCH_SIZE, RECOGNITION_FLUSH_TIMEOUT, MAX_WORKERS
+from face_engine import FaceEngine
+
+BATCH_SIZES = (1, 8, 16, 32, 64)
+
+
+def collect_crops(engine, photo_dir, max_photos):
+    per_photo = []
+    for root, _, files in os.walk(photo_dir):
+        for file in files:
+            if not file.lower().endswith(VALID_EXTENSIONS):
+                continue
+            faces = engine.detect_faces(os.path.join(root, file))
+            if faces:
+                per_photo.append([face.crop for face in faces])
+            if len(per_photo) >= max_photos:
+                return per_photo
+    return per_photo
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    photo_dir = sys.argv[1]
+    max_photos = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+
+    engine = FaceEngine()
+    per_photo = collect_crops(engine, photo_dir, max_photos)
+    crops = [crop for photo in per_photo for crop in photo]
+    if not crops:
+        print("No faces found.")
+        return
+    print(f"{len(per_photo)} photos with faces, {len(crops)} faces "
+          f"({len(crops) / len(per_photo):.2f} per photo)\n")
+
+    engine.embed_crops(crops[:1])  # Warm-up
+
+    reference, per_image_time = timed(
+        lambda: np.concatenate([engine.embed_crops(photo) for photo in per_photo])
+    )
+    print(f"{'per photo':>12}: {len(crops) / per_image_time:8.1f} faces/s  "
+          f"({engine.app.models['recognition'].session.get_session_options().intra_op_num_threads} "
+          f"ONNX threads per session)")
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        _, elapsed = timed(lambda: list(executor.map(engine.embed_crops, per_photo)))
+    print(f"{f'{MAX_WORKERS} threads':>12}: {len(crops) / elapsed:8.1f} faces/s  "
+          f"({per_image_time / elapsed:4.2f}x, one call per photo)")
+
+    for size in BATCH_SIZES:
+        embeddings, elapsed = timed(lambda: np.concatenate([
+            engine.embed_crops(crops[i:i + size]) for i in range(0, len(crops), size)
+        ]))
+        diff = float(np.max(np.abs(embeddings - reference)))
+        print(f"{f'batch {size}':>12}: {len(crops) / elapsed:8.1f} faces/s  "
+              f"({per_image_time / elapsed:4.2f}x, max diff {diff:.2e})")
+
+    # Through the scanner's batcher, submitting photo by photo
+    batcher = RecognitionBatcher(engine, RECOGNITION_BATCH_SIZE, RECOGNITION_FLUSH_TIMEOUT)
+
+    def run_batcher():
+        futures = [batcher.submit(photo) for photo in per_photo]
+        return np.concatenate([f.result() for f in futures])
+
+    embeddings, elapsed = timed(run_batcher)
+    batcher.close()
+    diff = float(np.max(np.abs(embeddings - reference)))
+    print(f"{'batcher':>12}: {len(crops) / elapsed:8.1f} faces/s  "
+          f"({per_image_time / elapsed:4.2f}x, max diff {diff:.2e}, "
+          f"{batcher.stats['batches']} batches)")
+
+
+if __name__ == "__main__":
+    main()
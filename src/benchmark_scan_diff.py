@@ -0,0 +1,67 @@
+"""Time move detection on large synthetic reorganisations.
+
+Usage:
+    python src/benchmark_scan_diff.py [moves ...]
+
+For each count (default 10000 and 100000), builds a throwaway database with
+that many indexed photos, lists all of them under new folders and times
+`apply_scan_moves`. Matching must stay close to linear: a tenfold larger
+reorganisation taking more than 30x longer is reported as a failure.
+"""
+import os
+import sys
+import tempfile
+import time
+
+from database import Database, folder_key
+
+ROOT = "/library"
+
+
+def time_moves(count):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"))
+        volume_id = db.add_volume(ROOT)
+        # Half the photos share a fingerprint with another, like burst shots
+        photos = [
+            (f"{ROOT}/old/{i % 100}/{i}.jpg", 1000 + i // 2, 1600000000, volume_id,
+             f"old/{i % 100}/{i}.jpg", folder_key(f"{ROOT}/old/{i % 100}/{i}.jpg"))
+            for i in range(count)
+        ]
+        with db.conn:
+            db.conn.executemany("""
+                INSERT INTO photos (file_path, file_size, last_modified, volume_id, rel_path, folder)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, photos)
+
+        db.begin_scan()
+        db.add_scan_files((f"{ROOT}/new/{i % 37}/{i}.jpg", f"new/{i % 37}/{i}.jpg") for i in range(count))
+        db.set_scan_file_stats(
+            [(1000 + i // 2, 1600000000, f"{ROOT}/new/{i % 37}/{i}.jpg") for i in range(count)]
+        )
+        start = time.perf_counter()
+        moved = db.apply_scan_moves(volume_id)
+        elapsed = time.perf_counter() - start
+        db.end_scan()
+        db.conn.close()
+
+    if moved != count:
+        raise SystemExit(f"{count:,} moves: only {moved:,} matched")
+    return elapsed
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    results = []
+    for count in counts:
+        elapsed = time_moves(count)
+        results.append((count, elapsed))
+        print(f"{count:>10,} moves: {elapsed:6.2f}s ({count / elapsed:,.0f}/s)")
+
+    for (small, t_small), (large, t_large) in zip(results, results[1:]):
+        if t_large / max(t_small, 1e-3) > 3 * large / small:
+            raise SystemExit(f"Move matching grows faster than linear: {small:,} -> {large:,}")
+
+
+if __name__ == "__main__":
+    main()
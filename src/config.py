@@ -7,15 +7,111 @@ DATABASE_PATH = os.path.join(BASE_DIR, "database.db")
 # Face comparison threshold (euclidean distance)
 FACE_DISTANCE_THRESHOLD = 1.15
 
+# Face embedding storage: "float32", "float16" or "int8" (per-vector scaled).
+# Changing this migrates an existing database in place on the next start.
+EMBEDDING_FORMAT = "float32"
+
+# Keep a float32 copy of compressed embeddings on disk for exact rescoring
+KEEP_FULL_PRECISION = True
+
+# Compressed-search candidates within this distance of the threshold
+# are rescored at full precision
+RESCORE_MARGIN = 0.05
+
+# Face quality gates (face size is the shorter bbox side in original pixels).
+# Faces below the ingest gates are not indexed at all; the search gates
+# filter already-indexed faces before they are scored.
+MIN_DET_SCORE = 0.5
+MIN_FACE_SIZE = 24
+SEARCH_MIN_DET_SCORE = 0.0
+SEARCH_MIN_FACE_SIZE = 0
+
+# Faces scored per step when searching; bounds search memory and sets how
+# often partial results reach the UI
+SEARCH_CHUNK_SIZE = 50000
+
+# Searches keep every photo closer than SEARCH_MAX_THRESHOLD, so the
+# threshold slider can go up to it without searching again. Results are
+# cached per person (sorted distance + photo id arrays) up to SEARCH_CACHE_MB.
+# Keep it well below 1.41 (sqrt 2), where unrelated faces cluster: near it,
+# a large part of the library would be kept and rescored.
+SEARCH_MAX_THRESHOLD = 1.25
+SEARCH_CACHE_MB = 64
+
+# Model precision: "float32" or "int8". INT8 models are built locally from
+# the installed ones with `python src/model_quantization.py build <dir>`,
+# which also has a `check` command to measure speed and accuracy.
+MODEL_PRECISION = "float32"
+QUANTIZED_MODEL_DIR = os.path.join(BASE_DIR, "models")
+
+# Store each face's aligned 112x112 crop (JPEG, a few KB per face) so
+# embeddings can be recomputed without rescanning when the recognition
+# model changes
+STORE_FACE_CROPS = False
+FACE_CROP_QUALITY = 95
+
 # Image resizing
 MAX_IMAGE_WIDTH = 1600
 RESIZE_WIDTH = 1000
 
+# Coarse-to-fine detection: run a cheap detection on the embedded EXIF
+# thumbnail (or a 1/8-scale decode) first and only decode the full image
+# when it finds a likely face. Lower COARSE_DET_THRESHOLD = more sensitive
+# (fewer missed faces, less time saved). COARSE_INPUT_SIZE is the detector
+# input side for the coarse pass (multiple of 32).
+COARSE_DETECTION = False
+COARSE_DET_THRESHOLD = 0.3
+COARSE_INPUT_SIZE = 320
+
+# Cross-image recognition batching during scans: aligned face crops from
+# many photos are embedded RECOGNITION_BATCH_SIZE at a time. A partial
+# batch waits at most RECOGNITION_FLUSH_TIMEOUT seconds. 1 disables it.
+RECOGNITION_BATCH_SIZE = 32
+RECOGNITION_FLUSH_TIMEOUT = 0.05
+
 # Valid extensions
 VALID_EXTENSIONS = (".jpg", ".jpeg", ".png")
 
+# Remount detection: when an unknown root is scanned, this many indexed
+# photos of each known volume are looked up under it; the volume is
+# relocated if at least RELOCATE_MIN_MATCH of them match by size+mtime
+RELOCATE_SAMPLE_SIZE = 20
+RELOCATE_MIN_MATCH = 0.8
+
+# Headless search server (src/server.py). Unauthenticated: keep it on localhost.
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+
 # Threads
 MAX_WORKERS = max(1, (os.cpu_count() or 4) - 1)
 
+# Directories listed and files stat'ed at once when a scan walks the
+# library. These threads mostly wait on the disk or network, so this can be
+# well above the core count; it pays off most on SMB/NFS mounts.
+LISTING_WORKERS = 16
+
+# Threads each ONNX model session may use. 0 derives it from the CPU budget
+# below: the budget's cores shared among the photos a scan runs at once, so
+# scan workers times ONNX threads stays within SCAN_CPU_BUDGET.
+ONNX_THREADS = 0
+
+# Scan resource budget. SCAN_CPU_BUDGET is the share of cores a scan may keep
+# busy (1.0 = up to MAX_WORKERS photos at once); SCAN_IO_BUDGET_MB caps the
+# photo read rate in MB/s (0 = unlimited). With SCAN_AUTO_THROTTLE the scan
+# gives CPU back while other programs are busy, re-checking the system load
+# every SCAN_THROTTLE_INTERVAL seconds.
+SCAN_CPU_BUDGET = 1.0
+SCAN_IO_BUDGET_MB = 0
+SCAN_AUTO_THROTTLE = True
+SCAN_THROTTLE_INTERVAL = 2.0
+
+# Scan progress: the GUI redraws every PROGRESS_REFRESH_MS milliseconds
+# however fast photos are processed. Rate and ETA are measured over the
+# last PROGRESS_RATE_WINDOW samples, taken at most every
+# PROGRESS_SAMPLE_INTERVAL seconds (100 x 0.1 s = the last 10 seconds).
+PROGRESS_REFRESH_MS = 100
+PROGRESS_RATE_WINDOW = 100
+PROGRESS_SAMPLE_INTERVAL = 0.1
+
 # Results directory (in project root)
 RESULTS_DIR = os.path.join(BASE_DIR, "results")
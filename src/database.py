@@ -1,13 +1,32 @@
+import os
 import sqlite3
 import threading
 import numpy as np
-from config import DATABASE_PATH
+import quantization
+from config import DATABASE_PATH, EMBEDDING_FORMAT, KEEP_FULL_PRECISION
+
+
+def normalize_root(path):
+    """Canonical form of a library root used as the volume key."""
+    return os.path.normpath(os.path.abspath(path))
+
+
+def folder_key(path):
+    """Folder of a photo with a trailing separator, for prefix matching."""
+    return os.path.join(os.path.dirname(path), "")
+
+
+def prefix_range(prefix):
+    """(low, high) bounds matching every string that starts with prefix."""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
 
 
 class Database:
-    def __init__(self):
+    def __init__(self, path=DATABASE_PATH):
         self._lock = threading.Lock()
-        self.conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.create_function("path_basename", 1, os.path.basename, deterministic=True)
+        self.conn.create_function("path_folder", 1, folder_key, deterministic=True)
         self._create_tables()
 
     def _create_tables(self):
@@ -28,12 +47,32 @@ class Database:
         )
         """)
 
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS volumes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            root_path TEXT UNIQUE
+        )
+        """)
+
+        # file_path is derived from the volume root + rel_path and is
+        # rewritten in bulk when a volume is relocated. folder (see
+        # folder_key) and taken_at ("YYYY-MM-DD HH:MM:SS", local time) let
+        # searches narrow the candidate faces before scoring them.
+        # taken_at_source is "exif" when taken_at was read from the file and
+        # "none" when the file has no capture time (taken_at stays NULL);
+        # NULL means the file has not been read yet.
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS photos (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             file_path TEXT UNIQUE,
             file_size INTEGER,
-            last_modified INTEGER
+            last_modified INTEGER,
+            volume_id INTEGER,
+            rel_path TEXT,
+            folder TEXT,
+            taken_at TEXT,
+            taken_at_source TEXT,
+            FOREIGN KEY(volume_id) REFERENCES volumes(id)
         )
         """)
 
@@ -42,15 +81,154 @@ class Database:
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             photo_id INTEGER,
             embedding BLOB,
+            embedding_full BLOB,
+            bbox_x1 REAL,
+            bbox_y1 REAL,
+            bbox_x2 REAL,
+            bbox_y2 REAL,
+            det_score REAL,
+            face_area REAL,
             FOREIGN KEY(photo_id) REFERENCES photos(id)
         )
         """)
 
+        # Photos matching each person, as zlib-compressed packed bits indexed
+        # by photo id (see person_index.py). face_mark is the last face id
+        # they cover, so new faces can be added incrementally.
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS person_bitmaps (
+            person_id INTEGER PRIMARY KEY,
+            model_version TEXT,
+            threshold REAL,
+            face_mark INTEGER,
+            bitmap BLOB,
+            FOREIGN KEY(person_id) REFERENCES persons(id)
+        )
+        """)
+
+        self._add_column_if_missing(cursor, "faces", "embedding_full", "BLOB")
+        for column in ("bbox_x1", "bbox_y1", "bbox_x2", "bbox_y2", "det_score", "face_area"):
+            self._add_column_if_missing(cursor, "faces", column, "REAL")
+        self._add_column_if_missing(cursor, "photos", "volume_id", "INTEGER")
+        self._add_column_if_missing(cursor, "photos", "rel_path", "TEXT")
+        self._add_column_if_missing(cursor, "photos", "folder", "TEXT")
+        self._add_column_if_missing(cursor, "photos", "taken_at", "TEXT")
+        self._add_column_if_missing(cursor, "photos", "taken_at_source", "TEXT")
+        cursor.execute("UPDATE photos SET folder = path_folder(file_path) WHERE folder IS NULL")
+
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_photos_path ON photos(file_path)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_photos_volume ON photos(volume_id, rel_path)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_photos_folder ON photos(folder)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_photos_taken_at ON photos(taken_at)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_faces_photo_id ON faces(photo_id)")
 
+        for table in ("faces", "persons"):
+            self._add_column_if_missing(cursor, table, "crop", "BLOB")
+            self._add_column_if_missing(cursor, table, "model_version", "TEXT")
+            self._add_column_if_missing(cursor, table, "next_embedding", "BLOB")
+            self._add_column_if_missing(cursor, table, "next_model_version", "TEXT")
+
+        self._migrate_embedding_format(cursor)
+        self._migrate_volumes(cursor)
+
         self.conn.commit()
 
+        cursor.execute("SELECT value FROM settings WHERE key='model_version'")
+        row = cursor.fetchone()
+        # Recognition model the searchable embeddings were computed with
+        self.model_version = row[0] if row else None
+
+    @staticmethod
+    def _add_column_if_missing(cursor, table, column, decl):
+        """Add a column to a table created by an older version of the app."""
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+    def _migrate_volumes(self, cursor):
+        """Assign photos indexed before volumes existed to the saved root."""
+        cursor.execute("SELECT 1 FROM photos WHERE volume_id IS NULL LIMIT 1")
+        if cursor.fetchone() is None:
+            return
+        cursor.execute("SELECT value FROM settings WHERE key='root_path'")
+        row = cursor.fetchone()
+        if not row or not row[0]:
+            return
+
+        root = normalize_root(row[0])
+        cursor.execute("INSERT OR IGNORE INTO volumes (root_path) VALUES (?)", (root,))
+        cursor.execute("SELECT id FROM volumes WHERE root_path=?", (root,))
+        self._adopt_photos(cursor, cursor.fetchone()[0], root)
+
+    @staticmethod
+    def _adopt_photos(cursor, volume_id, root):
+        """Move every photo under `root` into `volume_id` in one statement.
+
+        Covers legacy rows and nested roots (a parent or child folder of an
+        existing volume). Volumes left without photos are dropped.
+        """
+        prefix, upper = prefix_range(os.path.join(root, ""))
+        cursor.execute("""
+            UPDATE photos SET volume_id=?, rel_path=substr(file_path, ?)
+            WHERE file_path >= ? AND file_path < ?
+              AND (volume_id IS NULL OR volume_id != ?)
+        """, (volume_id, len(prefix) + 1, prefix, upper, volume_id))
+        adopted = cursor.rowcount
+        cursor.execute("""
+            DELETE FROM volumes
+            WHERE id != ? AND id NOT IN (
+                SELECT DISTINCT volume_id FROM photos WHERE volume_id IS NOT NULL
+            )
+        """, (volume_id,))
+        return adopted
+
+    def _migrate_embedding_format(self, cursor, batch_size=10000):
+        """Re-encode faces.embedding in place when EMBEDDING_FORMAT changes.
+
+        Databases without a recorded format predate compression and hold
+        float32 embeddings. When compressing, the float32 original is kept
+        in faces.embedding_full if KEEP_FULL_PRECISION is enabled.
+        """
+        cursor.execute("SELECT value FROM settings WHERE key='embedding_format'")
+        row = cursor.fetchone()
+        current = row[0] if row else "float32"
+        target = EMBEDDING_FORMAT
+        keep_full = KEEP_FULL_PRECISION and target != "float32"
+
+        if current != target:
+            last_id = 0
+            while True:
+                cursor.execute("""
+                    SELECT id, embedding, embedding_full FROM faces
+                    WHERE id > ? ORDER BY id LIMIT ?
+                """, (last_id, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+
+                updates = []
+                for face_id, emb_blob, full_blob in rows:
+                    if full_blob is None and current == "float32":
+                        full_blob = emb_blob
+                    if full_blob is not None:
+                        source = np.frombuffer(full_blob, dtype=np.float32)
+                    else:
+                        source = quantization.decode(emb_blob, current)
+                    new_full = full_blob if keep_full else None
+                    updates.append((quantization.encode(source, target), new_full, face_id))
+
+                cursor.executemany(
+                    "UPDATE faces SET embedding=?, embedding_full=? WHERE id=?", updates
+                )
+                last_id = rows[-1][0]
+        elif not keep_full:
+            cursor.execute("UPDATE faces SET embedding_full=NULL WHERE embedding_full IS NOT NULL")
+
+        cursor.execute("""
+            INSERT INTO settings (key, value) VALUES ('embedding_format', ?)
+            ON CONFLICT(key) DO UPDATE SET value=excluded.value
+        """, (target,))
+
     # ------------------------------------------------------------------
     # SETTINGS
     # ------------------------------------------------------------------
@@ -71,16 +249,31 @@ class Database:
             row = cursor.fetchone()
             return row[0] if row else None
 
+    @staticmethod
+    def _bump_index_generation(cursor):
+        cursor.execute("""
+            INSERT INTO settings (key, value) VALUES ('index_generation', 1)
+            ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+        """)
+
+    def get_index_generation(self):
+        """Counter bumped whenever photos or faces may have been added,
+        removed or re-embedded (after each scan and model migration)."""
+        value = self.get_setting("index_generation")
+        return int(value) if value else 0
+
     # ------------------------------------------------------------------
     # PERSONS
     # ------------------------------------------------------------------
-    def add_person(self, name, embedding):
+    def add_person(self, name, embedding, crop=None, model_version=None):
+        """Register a person. `crop` is the encoded aligned face, kept so
+        the embedding can be recomputed when the model changes."""
         with self._lock:
             cursor = self.conn.cursor()
             cursor.execute("""
-                INSERT INTO persons (name, embedding)
-                VALUES (?, ?)
-            """, (name, embedding.tobytes()))
+                INSERT INTO persons (name, embedding, crop, model_version)
+                VALUES (?, ?, ?, ?)
+            """, (name, embedding.tobytes(), crop, model_version or self.model_version))
             self.conn.commit()
 
     def get_persons(self):
@@ -98,27 +291,95 @@ class Database:
                 return np.frombuffer(row[0], dtype=np.float32)
             return None
 
+    def get_person_model_version(self, person_id):
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT model_version FROM persons WHERE id=?", (person_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
     # ------------------------------------------------------------------
-    # PHOTOS
+    # VOLUMES
     # ------------------------------------------------------------------
-    def add_photo(self, path, size, mtime):
+    def get_volumes(self):
         with self._lock:
             cursor = self.conn.cursor()
-            cursor.execute("""
-                INSERT INTO photos (file_path, file_size, last_modified)
-                VALUES (?, ?, ?)
-            """, (path, size, mtime))
+            cursor.execute("SELECT id, root_path FROM volumes ORDER BY id")
+            return cursor.fetchall()
+
+    def get_volume_id(self, root):
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT id FROM volumes WHERE root_path=?", (normalize_root(root),))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def add_volume(self, root):
+        """Register a library root and adopt already-indexed photos under it.
+
+        Returns the volume id.
+        """
+        root = normalize_root(root)
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("INSERT OR IGNORE INTO volumes (root_path) VALUES (?)", (root,))
+            cursor.execute("SELECT id FROM volumes WHERE root_path=?", (root,))
+            volume_id = cursor.fetchone()[0]
+            self._adopt_photos(cursor, volume_id, root)
             self.conn.commit()
-            return cursor.lastrowid
+            return volume_id
+
+    def adopt_photos(self, volume_id, root):
+        """Reassign photos indexed under another volume to this one."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            adopted = self._adopt_photos(cursor, volume_id, normalize_root(root))
+            self.conn.commit()
+            return adopted
 
-    def update_photo_path(self, old_path, new_path):
+    def relocate_volume(self, volume_id, new_root):
+        """Point a volume at a new mount path.
+
+        Rewrites every file_path of the volume with one set-based UPDATE.
+        """
+        new_root = normalize_root(new_root)
+        prefix = os.path.join(new_root, "")
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("UPDATE volumes SET root_path=? WHERE id=?", (new_root, volume_id))
+            cursor.execute(
+                """
+                UPDATE photos SET file_path = ? || rel_path, folder = path_folder(? || rel_path)
+                WHERE volume_id=?
+                """,
+                (prefix, prefix, volume_id),
+            )
+            self.conn.commit()
+            return cursor.rowcount
+
+    def sample_volume_photos(self, volume_id, limit):
+        """Random (rel_path, size, mtime) rows used to recognize a remount."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("""
+                SELECT rel_path, file_size, last_modified FROM photos
+                WHERE volume_id=? ORDER BY RANDOM() LIMIT ?
+            """, (volume_id, limit))
+            return cursor.fetchall()
+
+    # ------------------------------------------------------------------
+    # PHOTOS
+    # ------------------------------------------------------------------
+    def add_photo(self, path, size, mtime, volume_id=None, rel_path=None, taken_at=None, taken_at_source=None):
         with self._lock:
             cursor = self.conn.cursor()
             cursor.execute("""
-                UPDATE photos SET file_path=?
-                WHERE file_path=?
-            """, (new_path, old_path))
+                INSERT INTO photos (file_path, file_size, last_modified, volume_id, rel_path, folder,
+                                    taken_at, taken_at_source)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (path, size, mtime, volume_id, rel_path, folder_key(path), taken_at, taken_at_source))
             self.conn.commit()
+            return cursor.lastrowid
 
     def find_photo_by_fingerprint(self, file_size, last_modified):
         """Find photo by size+mtime to detect moved files.
@@ -133,86 +394,723 @@ class Database:
             """, (file_size, last_modified))
             return cursor.fetchone()
 
-    def remove_missing_photos(self, existing_paths):
-        """Remove photos from the database that no longer exist on disk.
-
-        Uses batch delete for performance.
-        """
+    def get_photo_count(self, volume_id=None):
+        """Returns the number of indexed photos (of one volume if given)."""
         with self._lock:
             cursor = self.conn.cursor()
-            cursor.execute("SELECT file_path FROM photos")
-            db_paths = {row[0] for row in cursor.fetchall()}
+            if volume_id is None:
+                cursor.execute("SELECT COUNT(*) FROM photos")
+            else:
+                cursor.execute("SELECT COUNT(*) FROM photos WHERE volume_id=?", (volume_id,))
+            return cursor.fetchone()[0]
 
-            missing = db_paths - existing_paths
-            if not missing:
+    def iter_photos_without_capture_time(self, volume_id, batch_size=1000):
+        """Yield batches of (id, file_path) whose capture time was never read.
+
+        Covers photos indexed before capture times were recorded, or while
+        a file's modification time stood in for a missing one.
+        """
+        last_id = 0
+        while True:
+            with self._lock:
+                cursor = self.conn.cursor()
+                cursor.execute("""
+                    SELECT id, file_path FROM photos
+                    WHERE volume_id=? AND taken_at_source IS NULL AND id > ?
+                    ORDER BY id LIMIT ?
+                """, (volume_id, last_id, batch_size))
+                rows = cursor.fetchall()
+            if not rows:
                 return
+            last_id = rows[-1][0]
+            yield rows
 
-            placeholders = ",".join("?" for _ in missing)
-            missing_list = list(missing)
+    def set_capture_times(self, rows):
+        """Record (taken_at, taken_at_source, photo_id) capture times."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.executemany("UPDATE photos SET taken_at=?, taken_at_source=? WHERE id=?", rows)
+            self.conn.commit()
 
-            cursor.execute(
-                f"DELETE FROM faces WHERE photo_id IN "
-                f"(SELECT id FROM photos WHERE file_path IN ({placeholders}))",
-                missing_list,
+    def get_person_count(self):
+        """Returns the number of registered persons."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM persons")
+            return cursor.fetchone()[0]
+
+    # ------------------------------------------------------------------
+    # SCAN DIFF
+    # Listed files are streamed into the temp table scan_files; new, moved
+    # and missing photos are then computed as indexed joins against photos,
+    # so no side of the diff has to be held in Python memory.
+    # ------------------------------------------------------------------
+    def begin_scan(self):
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS scan_files (
+                file_path TEXT PRIMARY KEY,
+                rel_path TEXT,
+                file_size INTEGER,
+                last_modified INTEGER
             )
-            cursor.execute(
-                f"DELETE FROM photos WHERE file_path IN ({placeholders})",
-                missing_list,
+            """)
+            cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS scan_moves (
+                photo_id INTEGER PRIMARY KEY,
+                new_path TEXT,
+                new_rel_path TEXT
             )
+            """)
+            cursor.execute("DELETE FROM scan_files")
+            cursor.execute("DELETE FROM scan_moves")
             self.conn.commit()
 
-    def get_all_photos(self):
+    def end_scan(self):
         with self._lock:
             cursor = self.conn.cursor()
-            cursor.execute("SELECT file_path, file_size, last_modified FROM photos")
-            return cursor.fetchall()
+            cursor.execute("DELETE FROM scan_files")
+            cursor.execute("DELETE FROM scan_moves")
+            self._bump_index_generation(cursor)
+            self.conn.commit()
+
+    def add_scan_files(self, rows, batch_size=5000):
+        """Stream (file_path, rel_path) rows of the directory listing."""
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                self._insert_scan_files(batch)
+                batch = []
+        if batch:
+            self._insert_scan_files(batch)
+
+    def _insert_scan_files(self, batch):
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.executemany(
+                "INSERT OR IGNORE INTO scan_files (file_path, rel_path) VALUES (?, ?)", batch
+            )
+            self.conn.commit()
 
-    def get_photo_count(self):
-        """Returns the number of indexed photos."""
+    def count_scan_files(self):
         with self._lock:
             cursor = self.conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM photos")
+            cursor.execute("SELECT COUNT(*) FROM scan_files")
             return cursor.fetchone()[0]
 
-    def get_person_count(self):
-        """Returns the number of registered persons."""
+    def _iter_scan_pages(self, query, params=(), batch_size=5000):
+        """Yield lists of rows from a scan_files query, paged by rowid.
+
+        The query must select scan_files.rowid first and accept the last
+        seen rowid and a limit as its final two parameters.
+        """
+        last_rowid = 0
+        while True:
+            with self._lock:
+                cursor = self.conn.cursor()
+                cursor.execute(query, (*params, last_rowid, batch_size))
+                rows = cursor.fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            yield [row[1:] for row in rows]
+
+    def iter_unindexed_scan_files(self, batch_size=5000):
+        """Yield batches of listed paths that match no indexed photo."""
+        query = """
+            SELECT s.rowid, s.file_path FROM scan_files s
+            WHERE NOT EXISTS (SELECT 1 FROM photos p WHERE p.file_path = s.file_path)
+              AND s.rowid > ?
+            ORDER BY s.rowid LIMIT ?
+        """
+        for rows in self._iter_scan_pages(query, batch_size=batch_size):
+            yield [row[0] for row in rows]
+
+    def count_unindexed_scan_files(self):
         with self._lock:
             cursor = self.conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM persons")
+            cursor.execute("""
+                SELECT COUNT(*) FROM scan_files s
+                WHERE NOT EXISTS (SELECT 1 FROM photos p WHERE p.file_path = s.file_path)
+            """)
             return cursor.fetchone()[0]
 
+    def set_scan_file_stats(self, rows):
+        """Record (size, mtime, file_path) fingerprints of listed files."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.executemany(
+                "UPDATE scan_files SET file_size=?, last_modified=? WHERE file_path=?", rows
+            )
+            self.conn.commit()
+
+    def apply_scan_moves(self, volume_id):
+        """Match unlisted photos with unindexed files by size+mtime.
+
+        Pairs with the same file name are matched first, the remaining ones
+        by fingerprint alone, so photos sharing a fingerprint keep their own
+        records. Returns the number of photos moved.
+        """
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("DELETE FROM scan_moves")
+            for partition in ("file_size, last_modified, name", "file_size, last_modified"):
+                # Both ranked candidate sets go into indexed temp tables first;
+                # joining the window subqueries directly scans one of them in
+                # full for every row of the other
+                cursor.execute("DROP TABLE IF EXISTS temp.move_sources")
+                cursor.execute("DROP TABLE IF EXISTS temp.move_targets")
+                cursor.execute(f"""
+                    CREATE TEMP TABLE move_sources AS
+                    SELECT id, file_size, last_modified, name,
+                           ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY file_path) AS rn
+                    FROM (
+                        SELECT p.id, p.file_path, p.file_size, p.last_modified,
+                               path_basename(p.file_path) AS name
+                        FROM photos p
+                        WHERE p.volume_id = ?
+                          AND NOT EXISTS (SELECT 1 FROM scan_files s WHERE s.file_path = p.file_path)
+                          AND p.id NOT IN (SELECT photo_id FROM scan_moves)
+                    )
+                """, (volume_id,))
+                cursor.execute(f"""
+                    CREATE TEMP TABLE move_targets AS
+                    SELECT file_path, rel_path, file_size, last_modified, name,
+                           ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY file_path) AS rn
+                    FROM (
+                        SELECT s.file_path, s.rel_path, s.file_size, s.last_modified,
+                               path_basename(s.file_path) AS name
+                        FROM scan_files s
+                        WHERE s.file_size IS NOT NULL
+                          AND NOT EXISTS (SELECT 1 FROM photos p WHERE p.file_path = s.file_path)
+                          AND s.file_path NOT IN (SELECT new_path FROM scan_moves)
+                    )
+                """)
+                cursor.execute(f"CREATE INDEX temp.move_targets_key ON move_targets ({partition}, rn)")
+                cursor.execute(f"""
+                    INSERT INTO scan_moves (photo_id, new_path, new_rel_path)
+                    SELECT m.id, n.file_path, n.rel_path
+                    FROM move_sources m
+                    JOIN move_targets n USING ({partition}, rn)
+                """)
+            cursor.execute("DROP TABLE IF EXISTS temp.move_sources")
+            cursor.execute("DROP TABLE IF EXISTS temp.move_targets")
+
+            cursor.execute("SELECT COUNT(*) FROM scan_moves")
+            moved = cursor.fetchone()[0]
+            if moved:
+                cursor.execute("""
+                    UPDATE photos SET
+                        file_path = (SELECT new_path FROM scan_moves WHERE photo_id = photos.id),
+                        rel_path = (SELECT new_rel_path FROM scan_moves WHERE photo_id = photos.id),
+                        folder = path_folder((SELECT new_path FROM scan_moves WHERE photo_id = photos.id))
+                    WHERE id IN (SELECT photo_id FROM scan_moves)
+                """)
+            self.conn.commit()
+            return moved
+
+    def remove_unlisted_photos(self, volume_id=None):
+        """Delete photos (and their faces) missing from scan_files.
+
+        Returns the number of photos removed.
+        """
+        volume_filter = "" if volume_id is None else "AND p.volume_id = :volume_id"
+        unlisted = f"""
+            SELECT p.id FROM photos p
+            WHERE NOT EXISTS (SELECT 1 FROM scan_files s WHERE s.file_path = p.file_path)
+            {volume_filter}
+        """
+        params = {"volume_id": volume_id}
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute(f"DELETE FROM faces WHERE photo_id IN ({unlisted})", params)
+            cursor.execute(f"DELETE FROM photos WHERE id IN ({unlisted})", params)
+            removed = cursor.rowcount
+            self.conn.commit()
+            return removed
+
     # ------------------------------------------------------------------
     # FACES
     # ------------------------------------------------------------------
-    def add_face(self, photo_id, embedding):
+    def add_face(self, photo_id, embedding, bbox=None, det_score=None, crop=None, model_version=None):
+        """Store one face. bbox is (x1, y1, x2, y2) in original pixels.
+
+        `crop` is the encoded aligned face (optional). Faces computed with a
+        model other than the active one stay out of searches until the
+        model migration finishes.
+        """
+        embedding = np.asarray(embedding, dtype=np.float32)
+        emb_blob = quantization.encode(embedding, EMBEDDING_FORMAT)
+        full_blob = None
+        if EMBEDDING_FORMAT != "float32" and KEEP_FULL_PRECISION:
+            full_blob = embedding.tobytes()
+
+        if bbox is not None:
+            x1, y1, x2, y2 = bbox
+            area = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+        else:
+            x1 = y1 = x2 = y2 = area = None
+
         with self._lock:
             cursor = self.conn.cursor()
             cursor.execute("""
-                INSERT INTO faces (photo_id, embedding)
-                VALUES (?, ?)
-            """, (photo_id, embedding.tobytes()))
+                INSERT INTO faces (photo_id, embedding, embedding_full,
+                                   bbox_x1, bbox_y1, bbox_x2, bbox_y2, det_score, face_area,
+                                   crop, model_version)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (photo_id, emb_blob, full_blob, x1, y1, x2, y2, det_score, area,
+                  crop, model_version or self.model_version))
             self.conn.commit()
 
-    def get_all_face_embeddings(self):
+    def _face_filter(self, min_det_score, min_face_size):
+        """WHERE clause and parameters shared by the face search queries.
+
+        Faces below `min_det_score` or whose shorter bbox side is below
+        `min_face_size` are filtered out in SQL, before their embeddings are
+        read. Faces indexed without geometry always pass. Only faces of the
+        active model version are kept.
+        """
+        clause = """
+            (faces.det_score IS NULL OR faces.det_score >= ?)
+            AND (faces.bbox_x1 IS NULL
+                 OR MIN(faces.bbox_x2 - faces.bbox_x1, faces.bbox_y2 - faces.bbox_y1) >= ?)
+            AND (? IS NULL OR faces.model_version = ?)
+        """
+        return clause, [min_det_score, min_face_size, self.model_version, self.model_version]
+
+    def _build_matrix(self, rows):
+        face_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        blobs = [row[1] for row in rows]
+        paths = [row[2] for row in rows]
+        photo_ids = np.fromiter((row[3] for row in rows), dtype=np.int64, count=len(rows))
+
+        loader = self.get_full_embeddings if KEEP_FULL_PRECISION else None
+        embeddings = quantization.EmbeddingMatrix.from_blobs(
+            blobs, EMBEDDING_FORMAT, face_ids=face_ids, full_loader=loader
+        )
+        return embeddings, paths, photo_ids
+
+    @staticmethod
+    def _photo_filter(taken_from=None, taken_to=None, folder=None):
+        """WHERE clause and parameters narrowing a search to some photos.
+
+        `taken_from` and `taken_to` are inclusive prefixes of "YYYY-MM-DD"
+        ("2019" to "2019" is the whole year); photos whose capture time is
+        unknown never match a date range. `folder` keeps photos anywhere
+        under that folder. Returns ("", []) when no filter is set.
+        """
+        clauses, params = [], []
+        if taken_from:
+            clauses.append("photos.taken_at >= ?")
+            params.append(taken_from)
+        if taken_to:
+            # "~" sorts after every character of a timestamp
+            clauses.append("photos.taken_at < ?")
+            params.append(taken_to + "~")
+        if folder:
+            low, high = prefix_range(os.path.join(normalize_root(folder), ""))
+            clauses.append("photos.folder >= ? AND photos.folder < ?")
+            params.extend([low, high])
+        return " AND ".join(clauses), params
+
+    def count_faces(self, min_det_score=0.0, min_face_size=0, **photo_filters):
+        """Number of faces iter_face_chunks would yield."""
+        where, params = self._face_filter(min_det_score, min_face_size)
+        photo_where, photo_params = self._photo_filter(**photo_filters)
+        if photo_where:
+            # CROSS JOIN keeps photos as the outer loop, so the photo
+            # indexes pick the candidates instead of a scan of all faces
+            source = "photos CROSS JOIN faces ON faces.photo_id = photos.id"
+            where = f"{photo_where} AND {where}"
+            params = photo_params + params
+        else:
+            source = "faces JOIN photos ON faces.photo_id = photos.id"
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute(f"SELECT COUNT(*) FROM {source} WHERE {where}", params)
+            return cursor.fetchone()[0]
+
+    def has_faces(self, min_det_score=0.0, min_face_size=0):
+        """Whether any face passes the search gates; stops at the first one."""
+        where, params = self._face_filter(min_det_score, min_face_size)
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM faces WHERE {where})", params)
+            return bool(cursor.fetchone()[0])
+
+    def get_face_id_range(self):
+        """(lowest, highest) face id, or None without faces.
+
+        Reads only the two ends of the primary key, unlike a count.
+        """
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT (SELECT MIN(id) FROM faces), (SELECT MAX(id) FROM faces)")
+            low, high = cursor.fetchone()
+            return None if low is None else (low, high)
+
+    def iter_face_chunks(self, chunk_size, min_det_score=0.0, min_face_size=0, after_face_id=0,
+                         **photo_filters):
+        """Yield (EmbeddingMatrix, paths, photo_ids) chunks of at most
+        `chunk_size` faces, optionally only faces added after `after_face_id`.
+
+        Pages by face id, so only one chunk is in memory at a time. With
+        photo filters (see _photo_filter) only the faces of matching photos
+        are read, so the cost follows the size of the subset.
+        """
+        where, params = self._face_filter(min_det_score, min_face_size)
+        photo_where, photo_params = self._photo_filter(**photo_filters)
+        if photo_where:
+            where = f"faces.id > ? AND {where}"
+            params = [after_face_id, *params]
+            yield from self._iter_photo_face_chunks(chunk_size, where, params, photo_where, photo_params)
+            return
+
+        last_id = after_face_id
+        while True:
+            with self._lock:
+                cursor = self.conn.cursor()
+                cursor.execute(f"""
+                    SELECT faces.id, faces.embedding, photos.file_path, photos.id
+                    FROM faces
+                    JOIN photos ON faces.photo_id = photos.id
+                    WHERE faces.id > ? AND {where}
+                    ORDER BY faces.id LIMIT ?
+                """, [last_id, *params, chunk_size])
+                rows = cursor.fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield self._build_matrix(rows)
+
+    def _iter_photo_face_chunks(self, chunk_size, where, params, photo_where, photo_params):
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute(f"SELECT id FROM photos WHERE {photo_where} ORDER BY id", photo_params)
+            photo_ids = np.fromiter((row[0] for row in cursor), dtype=np.int64)
+
+        rows = []
+        # Chunked to stay below SQLite's host parameter limit
+        for start in range(0, len(photo_ids), 500):
+            chunk = photo_ids[start:start + 500].tolist()
+            placeholders = ",".join("?" for _ in chunk)
+            with self._lock:
+                cursor = self.conn.cursor()
+                cursor.execute(f"""
+                    SELECT faces.id, faces.embedding, photos.file_path, photos.id
+                    FROM faces
+                    JOIN photos ON faces.photo_id = photos.id
+                    WHERE faces.photo_id IN ({placeholders}) AND {where}
+                """, [*chunk, *params])
+                rows.extend(cursor.fetchall())
+            while len(rows) >= chunk_size:
+                yield self._build_matrix(rows[:chunk_size])
+                rows = rows[chunk_size:]
+        if rows:
+            yield self._build_matrix(rows)
+
+    def get_full_embeddings(self, face_ids):
+        """Return float32 originals for the given face ids, in order.
+
+        Returns None if any of them has no full-precision copy.
+        """
+        face_ids = [int(i) for i in face_ids]
+        if not face_ids:
+            return np.empty((0, quantization.EMBEDDING_DIM), dtype=np.float32)
+
+        found = {}
         with self._lock:
             cursor = self.conn.cursor()
+            # Chunked to stay below SQLite's host parameter limit
+            for start in range(0, len(face_ids), 500):
+                chunk = face_ids[start:start + 500]
+                placeholders = ",".join("?" for _ in chunk)
+                cursor.execute(
+                    f"SELECT id, embedding_full FROM faces WHERE id IN ({placeholders})",
+                    chunk,
+                )
+                for face_id, blob in cursor.fetchall():
+                    if blob is not None:
+                        found[face_id] = blob
+
+        if len(found) < len(set(face_ids)):
+            return None
+        return np.vstack([np.frombuffer(found[i], dtype=np.float32) for i in face_ids])
+
+    # ------------------------------------------------------------------
+    # SHARDS
+    # A shard is a database file written by a headless scan of part of a
+    # library (see shard_scan.py); merging copies its photos and faces in
+    # with ids assigned by this database.
+    # ------------------------------------------------------------------
+    def merge_shard(self, shard_path, root=None):
+        """Fold the photos and faces of a shard into this database.
+
+        `root` is where the library is mounted here, when it differs from
+        the path the shard was scanned from (the shard must then hold a
+        single volume). Photos already indexed at the same path are kept
+        and the shard's copy is skipped, so merging is idempotent.
+
+        Returns (photos, faces) added. Raises ValueError when the shard was
+        built with another recognition model or embedding format.
+        """
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+            try:
+                return self._merge_attached_shard(cursor, root)
+            except Exception:
+                self.conn.rollback()
+                raise
+            finally:
+                cursor.execute("DETACH DATABASE shard")
+
+    def _merge_attached_shard(self, cursor, root):
+        cursor.execute("SELECT key, value FROM shard.settings")
+        shard_settings = dict(cursor.fetchall())
+        if shard_settings.get("embedding_format") != EMBEDDING_FORMAT:
+            raise ValueError(
+                f"Shard embeddings are stored as {shard_settings.get('embedding_format')}, "
+                f"this index uses {EMBEDDING_FORMAT}"
+            )
+        shard_model = shard_settings.get("model_version")
+        if self.model_version is None:
+            cursor.execute("SELECT 1 FROM photos LIMIT 1")
+            if cursor.fetchone() is None:
+                self.model_version = shard_model
+                cursor.execute("""
+                    INSERT INTO settings (key, value) VALUES ('model_version', ?)
+                    ON CONFLICT(key) DO UPDATE SET value=excluded.value
+                """, (shard_model,))
+        if shard_model != self.model_version:
+            raise ValueError(
+                f"Shard was built with model {shard_model}, this index uses {self.model_version}"
+            )
+
+        cursor.execute("SELECT id, root_path FROM shard.volumes")
+        volumes = cursor.fetchall()
+        if root is not None and len(volumes) > 1:
+            raise ValueError("A shard with several libraries cannot be merged under one root")
+
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM photos")
+        first_new = cursor.fetchone()[0] + 1
+        for shard_volume_id, shard_root in volumes:
+            target = normalize_root(root if root is not None else shard_root)
+            cursor.execute("INSERT OR IGNORE INTO volumes (root_path) VALUES (?)", (target,))
+            cursor.execute("SELECT id FROM volumes WHERE root_path=?", (target,))
+            volume_id = cursor.fetchone()[0]
+            prefix = os.path.join(target, "")
             cursor.execute("""
-                SELECT faces.embedding, photos.file_path
-                FROM faces
-                JOIN photos ON faces.photo_id = photos.id
-            """)
-            rows = cursor.fetchall()
+                INSERT INTO photos (file_path, file_size, last_modified, volume_id, rel_path, folder,
+                                    taken_at, taken_at_source)
+                SELECT ? || sp.rel_path, sp.file_size, sp.last_modified, ?, sp.rel_path,
+                       path_folder(? || sp.rel_path), sp.taken_at, sp.taken_at_source
+                FROM shard.photos sp
+                WHERE sp.volume_id = ?
+                  AND NOT EXISTS (SELECT 1 FROM photos p WHERE p.file_path = ? || sp.rel_path)
+                ORDER BY sp.id
+            """, (prefix, volume_id, prefix, shard_volume_id, prefix))
+            cursor.execute("""
+                INSERT INTO faces (photo_id, embedding, embedding_full,
+                                   bbox_x1, bbox_y1, bbox_x2, bbox_y2, det_score, face_area,
+                                   crop, model_version)
+                SELECT p.id, sf.embedding, sf.embedding_full,
+                       sf.bbox_x1, sf.bbox_y1, sf.bbox_x2, sf.bbox_y2, sf.det_score, sf.face_area,
+                       sf.crop, sf.model_version
+                FROM shard.faces sf
+                JOIN shard.photos sp ON sf.photo_id = sp.id
+                JOIN photos p ON p.file_path = ? || sp.rel_path
+                WHERE sp.volume_id = ? AND p.id >= ?
+                ORDER BY sf.id
+            """, (prefix, shard_volume_id, first_new))
+
+        cursor.execute("SELECT COUNT(*) FROM photos WHERE id >= ?", (first_new,))
+        photos = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM faces WHERE photo_id >= ?", (first_new,))
+        faces = cursor.fetchone()[0]
+        self._bump_index_generation(cursor)
+        self.conn.commit()
+        return photos, faces
+
+    # ------------------------------------------------------------------
+    # PERSON BITMAPS
+    # ------------------------------------------------------------------
+    def get_person_bitmap(self, person_id):
+        """Returns (model_version, threshold, face_mark, bitmap) or None."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("""
+                SELECT model_version, threshold, face_mark, bitmap FROM person_bitmaps
+                WHERE person_id=?
+            """, (person_id,))
+            return cursor.fetchone()
+
+    def set_person_bitmap(self, person_id, model_version, threshold, face_mark, bitmap):
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("""
+                INSERT INTO person_bitmaps (person_id, model_version, threshold, face_mark, bitmap)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(person_id) DO UPDATE SET
+                    model_version=excluded.model_version, threshold=excluded.threshold,
+                    face_mark=excluded.face_mark, bitmap=excluded.bitmap
+            """, (person_id, model_version, threshold, face_mark, bitmap))
+            self.conn.commit()
 
-        embeddings = []
-        paths = []
+    def get_max_face_id(self):
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM faces")
+            return cursor.fetchone()[0]
 
-        for emb_blob, path in rows:
-            embeddings.append(np.frombuffer(emb_blob, dtype=np.float32))
-            paths.append(path)
+    def get_photo_ids(self):
+        """Ids of all indexed photos as an int64 array."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT id FROM photos")
+            return np.fromiter((row[0] for row in cursor), dtype=np.int64)
 
-        if embeddings:
-            embeddings = np.vstack(embeddings)
-        else:
-            embeddings = np.empty((0, 512), dtype=np.float32)
+    def get_photo_paths(self, photo_ids):
+        """Returns {photo_id: file_path} for the given ids."""
+        photo_ids = [int(i) for i in photo_ids]
+        paths = {}
+        with self._lock:
+            cursor = self.conn.cursor()
+            # Chunked to stay below SQLite's host parameter limit
+            for start in range(0, len(photo_ids), 500):
+                chunk = photo_ids[start:start + 500]
+                placeholders = ",".join("?" for _ in chunk)
+                cursor.execute(f"SELECT id, file_path FROM photos WHERE id IN ({placeholders})", chunk)
+                paths.update(cursor.fetchall())
+        return paths
 
-        return embeddings, paths
+    # ------------------------------------------------------------------
+    # MODEL MIGRATION
+    # When the recognition model changes, embeddings are recomputed from
+    # the stored crops into next_embedding while searches keep using the
+    # old ones; finish_model_migration swaps them in one transaction.
+    # ------------------------------------------------------------------
+    def init_model_version(self, version):
+        """Record the model of an index that predates model versioning.
+
+        Returns the active model version.
+        """
+        with self._lock:
+            if self.model_version is None:
+                cursor = self.conn.cursor()
+                cursor.execute("UPDATE faces SET model_version=? WHERE model_version IS NULL", (version,))
+                cursor.execute("UPDATE persons SET model_version=? WHERE model_version IS NULL", (version,))
+                cursor.execute("""
+                    INSERT INTO settings (key, value) VALUES ('model_version', ?)
+                    ON CONFLICT(key) DO UPDATE SET value=excluded.value
+                """, (version,))
+                self.conn.commit()
+                self.model_version = version
+            return self.model_version
+
+    def iter_crops_to_reembed(self, table, target_version, batch_size=256):
+        """Yield batches of (id, crop) whose embedding is not yet `target_version`."""
+        last_id = 0
+        while True:
+            with self._lock:
+                cursor = self.conn.cursor()
+                cursor.execute(f"""
+                    SELECT id, crop FROM {table}
+                    WHERE crop IS NOT NULL AND id > ?
+                      AND model_version IS NOT ?
+                      AND next_model_version IS NOT ?
+                    ORDER BY id LIMIT ?
+                """, (last_id, target_version, target_version, batch_size))
+                rows = cursor.fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield rows
+
+    def set_next_embeddings(self, table, rows, target_version):
+        """Store (id, embedding) rows computed with `target_version`."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.executemany(
+                f"UPDATE {table} SET next_embedding=?, next_model_version=? WHERE id=?",
+                [(np.asarray(emb, dtype=np.float32).tobytes(), target_version, row_id) for row_id, emb in rows],
+            )
+            self.conn.commit()
+
+    def get_reembed_progress(self, target_version):
+        """Returns (done, total) faces with crops for the migration."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("""
+                SELECT COUNT(*),
+                       SUM(model_version IS ? OR next_model_version IS ?)
+                FROM faces WHERE crop IS NOT NULL
+            """, (target_version, target_version))
+            total, done = cursor.fetchone()
+            return done or 0, total
+
+    def finish_model_migration(self, target_version, batch_size=10000):
+        """Swap in the recomputed embeddings and make `target_version` active.
+
+        Photos with faces that could not be recomputed (no stored crop) are
+        dropped from the index so the next scan processes them again.
+        Returns (stale_photos, persons_without_crops).
+        """
+        keep_full = EMBEDDING_FORMAT != "float32" and KEEP_FULL_PRECISION
+        with self._lock:
+            cursor = self.conn.cursor()
+            last_id = 0
+            while True:
+                cursor.execute("""
+                    SELECT id, next_embedding FROM faces
+                    WHERE next_model_version = ? AND id > ?
+                    ORDER BY id LIMIT ?
+                """, (target_version, last_id, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                updates = []
+                for face_id, blob in rows:
+                    emb = np.frombuffer(blob, dtype=np.float32)
+                    updates.append((
+                        quantization.encode(emb, EMBEDDING_FORMAT),
+                        blob if keep_full else None,
+                        face_id,
+                    ))
+                cursor.executemany("""
+                    UPDATE faces SET embedding=?, embedding_full=?, next_embedding=NULL
+                    WHERE id=?
+                """, updates)
+                last_id = rows[-1][0]
+            cursor.execute("""
+                UPDATE faces SET model_version=next_model_version, next_model_version=NULL
+                WHERE next_model_version = ?
+            """, (target_version,))
+
+            cursor.execute("""
+                UPDATE persons SET embedding=next_embedding, model_version=next_model_version,
+                                   next_embedding=NULL, next_model_version=NULL
+                WHERE next_model_version = ?
+            """, (target_version,))
+            cursor.execute("SELECT COUNT(*) FROM persons WHERE model_version IS NOT ?", (target_version,))
+            persons_without_crops = cursor.fetchone()[0]
+
+            stale = """
+                SELECT DISTINCT photo_id FROM faces WHERE model_version IS NOT ?
+            """
+            cursor.execute(f"DELETE FROM photos WHERE id IN ({stale})", (target_version,))
+            stale_photos = cursor.rowcount
+            cursor.execute("""
+                DELETE FROM faces WHERE photo_id NOT IN (SELECT id FROM photos)
+            """)
+
+            cursor.execute("""
+                INSERT INTO settings (key, value) VALUES ('model_version', ?)
+                ON CONFLICT(key) DO UPDATE SET value=excluded.value
+            """, (target_version,))
+            self._bump_index_generation(cursor)
+            self.conn.commit()
+            self.model_version = target_version
+            return stale_photos, persons_without_crops
@@ -1,58 +1,279 @@
+import os
+import threading
+import time
+from collections import namedtuple
+
 import cv2
 import numpy as np
+import onnxruntime
 from insightface.app import FaceAnalysis
-from config import MAX_IMAGE_WIDTH, RESIZE_WIDTH
+from insightface.model_zoo import get_model
+from insightface.utils import face_align
+from config import (
+    MAX_IMAGE_WIDTH, RESIZE_WIDTH, FACE_DISTANCE_THRESHOLD, RESCORE_MARGIN,
+    COARSE_DET_THRESHOLD, COARSE_INPUT_SIZE, MODEL_PRECISION, FACE_CROP_QUALITY, ONNX_THREADS,
+    SCAN_CPU_BUDGET, MAX_WORKERS,
+)
+from model_quantization import quantized_path
+from quantization import EMBEDDING_DIM, EmbeddingMatrix
+from thumbnails import load_preview
+
+# bbox is (x1, y1, x2, y2) in original image pixels; crop is the aligned
+# face fed to the recognition model
+DetectedFace = namedtuple("DetectedFace", ["embedding", "bbox", "det_score", "crop"], defaults=(None,))
+
+
+def encode_crop(crop):
+    """Compress an aligned face crop (JPEG) for storage."""
+    ok, buf = cv2.imencode(".jpg", crop, [cv2.IMWRITE_JPEG_QUALITY, FACE_CROP_QUALITY])
+    return buf.tobytes() if ok else None
+
+
+def decode_crop(blob):
+    return cv2.imdecode(np.frombuffer(blob, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def _onnx_threads():
+    """ONNX_THREADS, or the cores of SCAN_CPU_BUDGET per scan worker."""
+    if ONNX_THREADS > 0:
+        return ONNX_THREADS
+    cores = max(1, round((os.cpu_count() or 1) * SCAN_CPU_BUDGET))
+    return max(1, cores // min(MAX_WORKERS, cores))
+
+
+def _make_session(path):
+    """CPU inference session limited to _onnx_threads() threads."""
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = _onnx_threads()
+    options.inter_op_num_threads = 1
+    return onnxruntime.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
 
 
 class FaceEngine:
-    def __init__(self):
-        self.app = FaceAnalysis(providers=['CPUExecutionProvider'])
+    def __init__(self, precision=MODEL_PRECISION):
+        # Landmark and gender/age models are not needed for search
+        self.app = FaceAnalysis(
+            allowed_modules=['detection', 'recognition'],
+            providers=['CPUExecutionProvider'],
+        )
         self.app.prepare(ctx_id=0)
+        rec_file = self.app.models['recognition'].model_file
+        self._rec_size = self.app.models['recognition'].input_size[0]
+        # Identifies the recognition model that produced an embedding. INT8
+        # mode approximates the same model, so it shares the version.
+        self.model_version = (
+            f"{os.path.splitext(os.path.basename(rec_file))[0]}-{os.path.getsize(rec_file)}"
+        )
+        self._det_model_file = self.app.det_model.model_file
+        self.precision = precision
+        if precision == "int8":
+            self._load_quantized_sessions()
+        elif precision != "float32":
+            raise ValueError(f"Unknown model precision: {precision!r}")
+        else:
+            # insightface does not pass session options through; reopen the
+            # same models with the thread limit
+            for model in (self.app.det_model, self.app.models['recognition']):
+                model.session = _make_session(model.model_file)
+        self._coarse_detector = None
+        self._stats_lock = threading.Lock()
+        self.reset_coarse_stats()
+
+    def _load_quantized_sessions(self):
+        """Swap the detection and recognition sessions for the INT8 models.
+
+        The models are built locally with `model_quantization.py build`.
+        """
+        for model in (self.app.det_model, self.app.models['recognition']):
+            path = quantized_path(model.model_file)
+            if not os.path.exists(path):
+                raise RuntimeError(
+                    f"INT8 model not found: {path}\n"
+                    "Build it with: python src/model_quantization.py build <photo_dir>"
+                )
+            model.session = _make_session(path)
+        self._det_model_file = quantized_path(self.app.det_model.model_file)
+
+    # ------------------------------------------------------------------
+    # COARSE PASS
+    # ------------------------------------------------------------------
+    def _get_coarse_detector(self):
+        """Separate detector session with a small input and a lower threshold.
+
+        A second instance keeps the settings of the main detector untouched
+        while scanner threads share this engine.
+        """
+        if self._coarse_detector is None:
+            detector = get_model(self._det_model_file, providers=['CPUExecutionProvider'])
+            detector.session = _make_session(self._det_model_file)
+            detector.prepare(
+                ctx_id=0,
+                input_size=(COARSE_INPUT_SIZE, COARSE_INPUT_SIZE),
+                det_thresh=COARSE_DET_THRESHOLD,
+            )
+            self._coarse_detector = detector
+        return self._coarse_detector
+
+    def reset_coarse_stats(self):
+        with self._stats_lock:
+            self._coarse_stats = {
+                "checked": 0,        # images that went through the coarse pass
+                "skipped": 0,        # of those, rejected without a full decode
+                "from_exif": 0,      # coarse passes that used the EXIF thumbnail
+                "coarse_time": 0.0,  # seconds spent in coarse passes
+                "full_count": 0,     # full decode + detection passes
+                "full_time": 0.0,    # seconds spent in them
+            }
+
+    def coarse_report(self):
+        """Summary of the coarse pass since the last reset.
+
+        `saved_time` estimates the full passes avoided (at the average
+        measured full-pass time) minus the cost of all coarse passes.
+        """
+        with self._stats_lock:
+            stats = dict(self._coarse_stats)
+        avg_full = stats["full_time"] / stats["full_count"] if stats["full_count"] else 0.0
+        stats["saved_time"] = max(0.0, stats["skipped"] * avg_full - stats["coarse_time"])
+        return stats
+
+    def _likely_has_face(self, image_path):
+        """Cheap detection on a thumbnail. Unreadable previews count as faces."""
+        start = time.perf_counter()
+        img, source = load_preview(image_path)
+        found = True
+        if img is not None:
+            size = (COARSE_INPUT_SIZE, COARSE_INPUT_SIZE)
+            bboxes, _ = self._get_coarse_detector().detect(img, input_size=size, max_num=1)
+            found = len(bboxes) > 0
+
+        with self._stats_lock:
+            self._coarse_stats["checked"] += 1
+            self._coarse_stats["coarse_time"] += time.perf_counter() - start
+            if source == "exif":
+                self._coarse_stats["from_exif"] += 1
+            if not found:
+                self._coarse_stats["skipped"] += 1
+        return found
 
     def _resize_if_needed(self, img):
+        """Returns (img, scale) where scale maps original to working pixels."""
         h, w = img.shape[:2]
         if w > MAX_IMAGE_WIDTH:
             scale = RESIZE_WIDTH / w
             img = cv2.resize(img, (0, 0), fx=scale, fy=scale)
-        return img
+            return img, scale
+        return img, 1.0
 
-    def extract_embeddings(self, image_path):
-        """Extract face embeddings from an image.
+    # ------------------------------------------------------------------
+    # EXTRACTION
+    # ------------------------------------------------------------------
+    def detect_faces(self, image_path, min_det_score=0.0, min_face_size=0, coarse=False):
+        """Detect and align faces without computing their embeddings.
 
+        Returns a list of DetectedFace with `embedding` set to None and
+        `crop` holding the 112x112 aligned face, ready for `embed_crops`.
+        Faces with a detection score below `min_det_score` or whose shorter
+        bbox side is below `min_face_size` original pixels are dropped.
+        With `coarse`, a cheap detection on the image thumbnail runs first
+        and the full image is only decoded if it finds a face.
         Returns an empty list if the image cannot be read or if any
         error occurs during detection (corrupted image, invalid format, etc).
         """
         try:
+            if coarse and not self._likely_has_face(image_path):
+                return []
+
+            start = time.perf_counter()
             img = cv2.imread(image_path)
             if img is None:
                 return []
 
-            img = self._resize_if_needed(img)
-            faces = self.app.get(img)
+            img, scale = self._resize_if_needed(img)
+            bboxes, kpss = self.app.det_model.detect(img, max_num=0, metric='default')
+            with self._stats_lock:
+                self._coarse_stats["full_count"] += 1
+                self._coarse_stats["full_time"] += time.perf_counter() - start
+
+            results = []
+            for i in range(bboxes.shape[0]):
+                bbox = tuple(float(v) / scale for v in bboxes[i, :4])
+                det_score = float(bboxes[i, 4])
+                size = min(bbox[2] - bbox[0], bbox[3] - bbox[1])
+                if det_score < min_det_score or size < min_face_size or kpss is None:
+                    continue
 
-            embeddings = []
-            for face in faces:
-                emb = face.embedding.astype(np.float32)
-                # Normalize to unit vector (essential for ArcFace)
-                norm = np.linalg.norm(emb)
-                if norm > 0:
-                    emb = emb / norm
-                embeddings.append(emb)
+                crop = face_align.norm_crop(img, landmark=kpss[i], image_size=self._rec_size)
+                results.append(DetectedFace(None, bbox, det_score, crop))
 
-            return embeddings
+            return results
         except Exception:
             # Corrupted image, invalid format, etc.
             return []
 
-    def compare(self, query_embedding, database_embeddings):
+    def embed_crops(self, crops):
+        """Run recognition on aligned crops in one batch.
+
+        Returns an (N, 512) float32 array of unit-length embeddings.
+        """
+        if len(crops) == 0:
+            return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+        embeddings = self.app.models['recognition'].get_feat(list(crops)).astype(np.float32)
+        # Normalize to unit vectors (essential for ArcFace)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-10)
+
+    def extract_faces(self, image_path, min_det_score=0.0, min_face_size=0, coarse=False):
+        """Detect faces and return a list of DetectedFace with embeddings.
+
+        See `detect_faces` for the arguments. Returns an empty list on any
+        error (corrupted image, invalid format, etc).
+        """
+        faces = self.detect_faces(image_path, min_det_score, min_face_size, coarse)
+        if not faces:
+            return []
+        try:
+            embeddings = self.embed_crops([face.crop for face in faces])
+        except Exception:
+            return []
+        return [face._replace(embedding=emb) for face, emb in zip(faces, embeddings)]
+
+    def extract_embeddings(self, image_path):
+        """Extract face embeddings from an image (see extract_faces)."""
+        return [face.embedding for face in self.extract_faces(image_path)]
+
+    def compare(self, query_embedding, database_embeddings, threshold=FACE_DISTANCE_THRESHOLD,
+                exact_matches=False):
         """Compare one embedding against a matrix of embeddings.
 
         Normalizes both sides before computing the Euclidean distance,
         ensuring values in the range [0, 2].
+
+        `database_embeddings` may be a float array or an EmbeddingMatrix.
+        Compressed matrices are scored on their codes first; rows whose
+        approximate distance is within RESCORE_MARGIN of `threshold` are
+        then rescored at full precision so match decisions stay exact.
+        With `exact_matches`, every row below threshold + RESCORE_MARGIN is
+        rescored instead, so matches can later be cut at any lower threshold
+        with exact decisions.
         """
         if len(database_embeddings) == 0:
             return np.array([])
 
+        if isinstance(database_embeddings, EmbeddingMatrix):
+            if not database_embeddings.is_compressed:
+                database_embeddings = database_embeddings.codes
+            else:
+                distances = database_embeddings.approx_distances(query_embedding)
+                if exact_matches:
+                    near = np.flatnonzero(distances <= threshold + RESCORE_MARGIN)
+                else:
+                    near = np.flatnonzero(np.abs(distances - threshold) <= RESCORE_MARGIN)
+                if len(near):
+                    distances[near] = database_embeddings.exact_distances(query_embedding, near)
+                return distances
+
         # Normalize query
         q_norm = np.linalg.norm(query_embedding)
         if q_norm > 0:
@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from config import (
+    MAX_WORKERS, SCAN_CPU_BUDGET, SCAN_IO_BUDGET_MB, SCAN_AUTO_THROTTLE, SCAN_THROTTLE_INTERVAL,
+)
+
+
+class ScanCancelled(Exception):
+    pass
+
+
+def _read_cpu_times():
+    """(busy, total) jiffies of all CPUs from /proc/stat, or None."""
+    try:
+        with open("/proc/stat") as f:
+            fields = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)  # idle + iowait
+    total = sum(fields[:8])  # guest time is already counted in user/nice
+    return total - idle, total
+
+
+class SystemLoad:
+    """Share of the machine's CPU used by other processes, from 0 to 1.
+
+    Read from /proc/stat where available, otherwise estimated from the load
+    average. This process's own CPU time is subtracted, so a scan does not
+    throttle itself. Returns None where neither source exists (Windows).
+    """
+
+    def __init__(self):
+        self._cpus = os.cpu_count() or 1
+        self._last = None
+
+    def sample(self):
+        now = time.monotonic()
+        own = time.process_time()
+        cpu = _read_cpu_times()
+        last, self._last = self._last, (now, own, cpu)
+        if last is None:
+            return None
+
+        wall = now - last[0]
+        if wall <= 0:
+            return None
+        own_share = (own - last[1]) / wall / self._cpus
+        if cpu is not None and last[2] is not None:
+            total = cpu[1] - last[2][1]
+            if total <= 0:
+                return None
+            busy = (cpu[0] - last[2][0]) / total
+        elif hasattr(os, "getloadavg"):
+            busy = os.getloadavg()[0] / self._cpus
+        else:
+            return None
+        return min(1.0, max(0.0, busy - own_share))
+
+
+class ResourceGovernor:
+    """CPU and I/O budget for a scan, with pause and resume.
+
+    Scanner threads hold a `slot` while they decode and detect, so at most
+    `limit` photos are being worked on at once, and call `throttle_io` with
+    the size of each file before reading it. The limit starts at
+    `cpu_budget` of the cores (at most `max_workers`); with `auto_throttle`
+    it drops while other processes keep the machine busy and climbs back
+    when they stop, one step per `interval` seconds.
+
+    `pause` holds every thread at its next slot or read until `resume`;
+    work in progress finishes and nothing is thrown away. `cancel` wakes
+    waiting threads with ScanCancelled, except those waiting for a slot
+    that is not `cancellable`: they go ahead so in-flight work can finish.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, cpu_budget=SCAN_CPU_BUDGET, io_budget_mb=SCAN_IO_BUDGET_MB,
+                 auto_throttle=SCAN_AUTO_THROTTLE, interval=SCAN_THROTTLE_INTERVAL):
+        cpus = os.cpu_count() or 1
+        self.max_limit = max(1, min(max_workers, round(cpus * cpu_budget)))
+        self.cpu_budget = cpu_budget
+        self.io_rate = io_budget_mb * 1024 * 1024 if io_budget_mb > 0 else None
+        self.auto_throttle = auto_throttle
+        self.interval = interval
+        self._cpus = cpus
+        self._cond = threading.Condition()
+        self._load = SystemLoad()
+        self.reset()
+
+    def reset(self):
+        """Clear pause and cancellation and start at the full budget."""
+        with self._cond:
+            self.limit = self.max_limit
+            self._active = 0
+            self._paused = False
+            self._cancelled = False
+            self._io_next = time.monotonic()
+            self._next_check = time.monotonic() + self.interval
+            self._load.sample()
+            self._cond.notify_all()
+
+    # ------------------------------------------------------------------
+    # PAUSE / CANCEL
+    # ------------------------------------------------------------------
+    def pause(self):
+        with self._cond:
+            self._paused = True
+
+    def resume(self):
+        with self._cond:
+            self._paused = False
+            self._cond.notify_all()
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+    @property
+    def is_paused(self):
+        return self._paused
+
+    def _wait(self, ready, timeout=None, cancellable=True):
+        """Wait under the lock until ready() holds; raise on cancel."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._cancelled and (self._paused or not ready()):
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0 and not self._paused:
+                break
+            # Wake up now and then to re-read the system load
+            self._cond.wait(self.interval if remaining is None or self._paused else min(remaining, self.interval))
+            self._adjust()
+        if self._cancelled and cancellable:
+            raise ScanCancelled("Scan cancelled")
+
+    def wait_if_paused(self):
+        """Block while paused. Raises ScanCancelled if the scan is cancelled."""
+        with self._cond:
+            self._wait(lambda: True)
+
+    # ------------------------------------------------------------------
+    # CPU
+    # ------------------------------------------------------------------
+    @contextmanager
+    def slot(self, cancellable=True):
+        """Hold one of the `limit` CPU slots for the duration of the block."""
+        with self._cond:
+            self._adjust()
+            self._wait(lambda: self._active < self.limit, cancellable=cancellable)
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def _adjust(self):
+        """Move the limit one step towards the CPU left by other processes."""
+        if not self.auto_throttle:
+            return
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.interval
+        others = self._load.sample()
+        if others is None:
+            return
+        target = max(1, min(self.max_limit, int((1.0 - others) * self._cpus)))
+        if target < self.limit:
+            self.limit -= 1
+        elif target > self.limit:
+            self.limit += 1
+            self._cond.notify_all()
+
+    # ------------------------------------------------------------------
+    # I/O
+    # ------------------------------------------------------------------
+    def throttle_io(self, nbytes):
+        """Wait until reading `nbytes` more stays within the I/O budget."""
+        with self._cond:
+            self._wait(lambda: True)
+            if self.io_rate is None:
+                return
+            # Reads are spaced out so the average rate stays at io_rate; up
+            # to a second of unused budget can be spent in a burst
+            now = time.monotonic()
+            start = max(self._io_next, now - 1.0)
+            self._io_next = start + nbytes / self.io_rate
+            self._wait(lambda: time.monotonic() >= start, timeout=start - now)
@@ -0,0 +1,72 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from config import LISTING_WORKERS
+
+
+def _list_dir(path):
+    """(path, subdirectory names, file names) of one directory.
+
+    Symlinked directories are not followed, and an unreadable directory
+    comes back empty, as with os.walk.
+    """
+    dirs, files = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                    if is_dir and not entry.is_symlink():
+                        dirs.append(entry.name)
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry.name)
+    except OSError:
+        pass
+    return path, dirs, files
+
+
+def walk_parallel(root, workers=LISTING_WORKERS, should_stop=None):
+    """Yield (dirpath, filenames) for every directory under root.
+
+    Like os.walk, but up to `workers` directories are listed at once, which
+    hides the round trip of each listing on network filesystems. Results
+    come in completion order as soon as each directory is read. Stops early
+    when `should_stop()` returns True, checked between directories.
+    """
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque([root])
+    futures = set()
+    try:
+        while pending or futures:
+            if should_stop is not None and should_stop():
+                return
+            # Deepest directories first keeps the pending list short
+            while pending and len(futures) < workers * 2:
+                futures.add(executor.submit(_list_dir, pending.pop()))
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, dirs, files = future.result()
+                pending.extend(os.path.join(path, name) for name in dirs)
+                yield path, files
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, int(st.st_mtime), path
+
+
+def stat_files(paths, workers=LISTING_WORKERS):
+    """(size, mtime, path) of each path, stat'ed `workers` at a time.
+
+    Paths that cannot be stat'ed are left out.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [row for row in executor.map(_stat, paths) if row is not None]
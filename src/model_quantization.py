@@ -0,0 +1,219 @@
+"""Build INT8 versions of the InsightFace models and check their accuracy.
+
+Usage:
+    python src/model_quantization.py build <photo_dir> [max_photos]
+    python src/model_quantization.py check <photo_dir> [max_photos]
+
+`build` statically quantizes the installed detection and recognition
+models (weights and activations to INT8, QDQ format), calibrating on
+photos from `photo_dir`, and writes them to QUANTIZED_MODEL_DIR.
+Set MODEL_PRECISION = "int8" in config.py to use them.
+
+`check` runs the float32 and INT8 engines on the same photos and reports
+embedding similarity, detection agreement, match decisions at
+FACE_DISTANCE_THRESHOLD and the speed of both.
+"""
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+from config import QUANTIZED_MODEL_DIR, FACE_DISTANCE_THRESHOLD, VALID_EXTENSIONS
+
+
+def quantized_path(model_file):
+    """Where the INT8 version of an installed model file is cached."""
+    name = os.path.splitext(os.path.basename(model_file))[0]
+    return os.path.join(QUANTIZED_MODEL_DIR, f"{name}.int8.onnx")
+
+
+def sample_photos(photo_dir, max_photos):
+    paths = []
+    for root, _, files in os.walk(photo_dir):
+        for file in sorted(files):
+            if file.lower().endswith(VALID_EXTENSIONS):
+                paths.append(os.path.join(root, file))
+                if len(paths) >= max_photos:
+                    return paths
+    return paths
+
+
+def _detection_blob(det_model, img):
+    """Replicates the letterboxing and normalization of the detector."""
+    input_w, input_h = det_model.input_size
+    h, w = img.shape[:2]
+    if h / w > input_h / input_w:
+        new_h = input_h
+        new_w = int(new_h * w / h)
+    else:
+        new_w = input_w
+        new_h = int(new_w * h / w)
+    det_img = np.zeros((input_h, input_w, 3), dtype=np.uint8)
+    det_img[:new_h, :new_w, :] = cv2.resize(img, (new_w, new_h))
+    mean = det_model.input_mean
+    return cv2.dnn.blobFromImage(
+        det_img, 1.0 / det_model.input_std, (input_w, input_h), (mean, mean, mean), swapRB=True
+    )
+
+
+def _recognition_blob(rec_model, crop):
+    mean = rec_model.input_mean
+    return cv2.dnn.blobFromImages(
+        [crop], 1.0 / rec_model.input_std, rec_model.input_size, (mean, mean, mean), swapRB=True
+    )
+
+
+def build(photo_dir, max_photos=100):
+    """Quantize detection and recognition models calibrated on local photos."""
+    from onnxruntime.quantization import (
+        CalibrationDataReader, QuantFormat, QuantType, quant_pre_process, quantize_static,
+    )
+    from face_engine import FaceEngine
+
+    class BlobReader(CalibrationDataReader):
+        def __init__(self, input_name, blobs):
+            self._inputs = iter([{input_name: blob} for blob in blobs])
+
+        def get_next(self):
+            return next(self._inputs, None)
+
+    engine = FaceEngine(precision="float32")
+    det_model = engine.app.det_model
+    rec_model = engine.app.models['recognition']
+
+    det_blobs, rec_blobs = [], []
+    for path in sample_photos(photo_dir, max_photos):
+        img = cv2.imread(path)
+        if img is None:
+            continue
+        img, _ = engine._resize_if_needed(img)
+        det_blobs.append(_detection_blob(det_model, img))
+        rec_blobs.extend(_recognition_blob(rec_model, face.crop) for face in engine.detect_faces(path))
+
+    if not det_blobs or not rec_blobs:
+        raise RuntimeError(f"No usable photos with faces found in {photo_dir}")
+
+    os.makedirs(QUANTIZED_MODEL_DIR, exist_ok=True)
+    for model, blobs in ((det_model, det_blobs), (rec_model, rec_blobs)):
+        output = quantized_path(model.model_file)
+        print(f"Quantizing {os.path.basename(model.model_file)} on {len(blobs)} samples...")
+        # Graph optimization and shape inference give better quantization
+        preprocessed = output.replace(".int8.onnx", ".pre.onnx")
+        quant_pre_process(model.model_file, preprocessed, skip_symbolic_shape=True)
+        quantize_static(
+            preprocessed,
+            output,
+            BlobReader(model.input_name, blobs),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+        )
+        os.remove(preprocessed)
+        print(f"  -> {output}")
+
+
+def _match_iou(box, boxes):
+    if not boxes:
+        return 0.0
+    boxes = np.asarray(boxes)
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    inter = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return float(np.max(inter / (area + areas - inter)))
+
+
+def check(photo_dir, max_photos=200):
+    """Compare INT8 against float32 on a local sample and print a report."""
+    from face_engine import FaceEngine
+
+    fp32 = FaceEngine(precision="float32")
+    int8 = FaceEngine(precision="int8")
+    paths = sample_photos(photo_dir, max_photos)
+
+    timings = {"fp32_det": 0.0, "int8_det": 0.0, "fp32_rec": 0.0, "int8_rec": 0.0}
+    ref_faces = 0
+    found_faces = 0
+    matched_boxes = 0
+    ref_embeddings, int8_embeddings = [], []
+
+    for path in paths:
+        start = time.perf_counter()
+        faces = fp32.detect_faces(path)
+        timings["fp32_det"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        int8_faces = int8.detect_faces(path)
+        timings["int8_det"] += time.perf_counter() - start
+
+        ref_faces += len(faces)
+        found_faces += len(int8_faces)
+        int8_boxes = [face.bbox for face in int8_faces]
+        matched_boxes += sum(_match_iou(face.bbox, int8_boxes) >= 0.5 for face in faces)
+
+        if not faces:
+            continue
+        # Recognition is compared on the same float32 crops, so the numbers
+        # reflect the recognition model alone
+        crops = [face.crop for face in faces]
+        start = time.perf_counter()
+        ref_embeddings.append(fp32.embed_crops(crops))
+        timings["fp32_rec"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        int8_embeddings.append(int8.embed_crops(crops))
+        timings["int8_rec"] += time.perf_counter() - start
+
+    print(f"Photos: {len(paths)}   float32 faces: {ref_faces}   int8 faces: {found_faces}")
+    if ref_faces:
+        print(f"Detection recall vs float32 (IoU >= 0.5): {matched_boxes / ref_faces:.2%}")
+    for stage in ("det", "rec"):
+        fp, q = timings[f"fp32_{stage}"], timings[f"int8_{stage}"]
+        if q > 0:
+            print(f"{'Detection' if stage == 'det' else 'Recognition'} time: "
+                  f"float32 {fp:.2f}s, int8 {q:.2f}s ({fp / q:.2f}x)")
+
+    if not ref_embeddings:
+        return
+    ref = np.vstack(ref_embeddings)
+    quant = np.vstack(int8_embeddings)
+    cosine = np.sum(ref * quant, axis=1)
+    print(f"Embedding cosine similarity: mean {cosine.mean():.4f}, min {cosine.min():.4f}")
+
+    # Match decisions between every pair of sample faces
+    def pairwise(e):
+        sq = np.sum(e * e, axis=1)
+        return np.sqrt(np.maximum(sq[:, None] + sq[None, :] - 2 * e @ e.T, 0))
+
+    iu = np.triu_indices(len(ref), k=1)
+    ref_match = pairwise(ref)[iu] < FACE_DISTANCE_THRESHOLD
+    int8_match = pairwise(quant)[iu] < FACE_DISTANCE_THRESHOLD
+    print(f"Face pairs: {len(ref_match)}   decision agreement: {np.mean(ref_match == int8_match):.4%}")
+    if ref_match.any():
+        recall = np.sum(ref_match & int8_match) / np.sum(ref_match)
+        print(f"Match recall vs float32 at threshold {FACE_DISTANCE_THRESHOLD}: {recall:.2%}")
+    print(f"New matches not made by float32: {np.sum(int8_match & ~ref_match)}")
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ("build", "check"):
+        print(__doc__)
+        sys.exit(1)
+    command, photo_dir = sys.argv[1], sys.argv[2]
+    if len(sys.argv) > 3:
+        max_photos = int(sys.argv[3])
+    else:
+        max_photos = 100 if command == "build" else 200
+    if command == "build":
+        build(photo_dir, max_photos)
+    else:
+        check(photo_dir, max_photos)
+
+
+if __name__ == "__main__":
+    main()
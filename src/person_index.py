@@ -0,0 +1,195 @@
+import re
+import threading
+import zlib
+
+import numpy as np
+from config import (
+    FACE_DISTANCE_THRESHOLD, SEARCH_CHUNK_SIZE, SEARCH_MIN_DET_SCORE, SEARCH_MIN_FACE_SIZE,
+)
+
+_TOKEN = re.compile(r"\s*([&|!()])\s*")
+
+
+def _to_bits(photo_ids, size):
+    bits = np.zeros(size, dtype=bool)
+    bits[photo_ids] = True
+    return np.packbits(bits)
+
+
+def _resize(packed, nbytes):
+    if len(packed) >= nbytes:
+        return packed[:nbytes]
+    return np.concatenate([packed, np.zeros(nbytes - len(packed), dtype=np.uint8)])
+
+
+class PersonIndex:
+    """Photos matching each registered person, kept as bitmaps over photo ids.
+
+    A photo matches a person when one of its faces is within `threshold`
+    of the person's embedding, the same rule as a search. Bitmaps are
+    stored in the database and brought up to date by `refresh`: only faces
+    added since the last refresh are scored, and photos removed by a scan
+    are masked out. Queries combining several persons are then plain
+    bitwise operations.
+    """
+
+    def __init__(self, database, engine, threshold=FACE_DISTANCE_THRESHOLD):
+        self.db = database
+        self.engine = engine
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._bitmaps = {}  # person_id -> packed bits
+        self._live = np.zeros(0, dtype=np.uint8)
+        self._state = None  # (index generation, model version, person ids)
+
+    def refresh(self):
+        """Bring the bitmaps in step with the index and registered persons.
+
+        Cheap when nothing changed since the last call.
+        """
+        with self._lock:
+            persons = {
+                person_id: name for person_id, name in self.db.get_persons()
+                if self.db.get_person_model_version(person_id) == self.db.model_version
+            }
+            state = (self.db.get_index_generation(), self.db.model_version, frozenset(persons))
+            if state == self._state:
+                return
+
+            # Read the face mark first, so every face it covers belongs to a
+            # photo in the snapshot below
+            face_mark = self.db.get_max_face_id()
+            photo_ids = self.db.get_photo_ids()
+            size = int(photo_ids.max()) + 1 if len(photo_ids) else 0
+            self._live = _to_bits(photo_ids, size)
+
+            bitmaps = {person_id: self._load_person(person_id, size) for person_id in persons}
+            self._score_new_faces(bitmaps, face_mark)
+            for person_id, (bits, _) in bitmaps.items():
+                packed = np.packbits(bits) & self._live
+                self.db.set_person_bitmap(
+                    person_id, self.db.model_version, self.threshold, face_mark,
+                    zlib.compress(packed.tobytes()),
+                )
+                bitmaps[person_id] = packed
+            self._bitmaps = bitmaps
+            self._state = state
+
+    def _load_person(self, person_id, size):
+        """(bits, face mark) stored for a person, or empty bits and 0."""
+        stored = self.db.get_person_bitmap(person_id)
+        if stored and stored[0] == self.db.model_version and stored[1] == self.threshold:
+            packed = np.frombuffer(zlib.decompress(stored[3]), dtype=np.uint8)
+            bits = np.unpackbits(_resize(packed, len(self._live)))[:size].astype(bool)
+            return bits, stored[2]
+        return np.zeros(size, dtype=bool), 0
+
+    def _score_new_faces(self, bitmaps, face_mark):
+        """Set the bits of photos with faces newer than each person's mark.
+
+        The faces table is read once, from the oldest mark, and every chunk
+        is scored against each person that has not seen it yet. Faces above
+        face_mark (a scan in progress) are picked up by the next refresh.
+        """
+        pending = {
+            person_id: (self.db.get_person_embedding(person_id), bits, after)
+            for person_id, (bits, after) in bitmaps.items() if after < face_mark
+        }
+        if not pending:
+            return
+        start = min(after for _, _, after in pending.values())
+        for embeddings, _, photo_ids in self.db.iter_face_chunks(
+            SEARCH_CHUNK_SIZE, min_det_score=SEARCH_MIN_DET_SCORE,
+            min_face_size=SEARCH_MIN_FACE_SIZE, after_face_id=start,
+        ):
+            face_ids = embeddings.face_ids
+            for query, bits, after in pending.values():
+                if face_ids[-1] <= after:
+                    continue
+                distances = self.engine.compare(query, embeddings, self.threshold)
+                matched = photo_ids[(distances < self.threshold) & (face_ids > after)]
+                bits[matched[matched < len(bits)]] = True
+
+    def photo_ids(self, person_id):
+        """Ids of the photos matching one person (after `refresh`)."""
+        packed = self._bitmaps.get(person_id)
+        if packed is None:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(np.unpackbits(packed))
+
+    def query(self, expression, person_ids):
+        """Evaluate a query such as "Alice & Bob" or "Alice & !(Bob | Carol)".
+
+        `&` is AND, `|` is OR, `!` is NOT (relative to all indexed photos)
+        and parentheses group. `person_ids` maps names to person ids.
+        Calls `refresh` first. Returns the matching photo paths, sorted.
+        Raises ValueError for a malformed query, an unknown name or a
+        person registered with another recognition model.
+        """
+        self.refresh()
+        with self._lock:
+            packed = _Parser(expression, person_ids, self._bitmaps, self._live).parse()
+        ids = np.flatnonzero(np.unpackbits(packed))
+        return sorted(self.db.get_photo_paths(ids).values())
+
+
+class _Parser:
+    """Recursive descent over: expr := term ('|' term)*,
+    term := factor ('&' factor)*, factor := '!' factor | '(' expr ')' | name."""
+
+    def __init__(self, expression, person_ids, bitmaps, live):
+        self.tokens = [t.strip() for t in _TOKEN.split(expression) if t and t.strip()]
+        self.pos = 0
+        self.person_ids = person_ids
+        self.bitmaps = bitmaps
+        self.live = live
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError("Empty query.")
+        result = self._expr()
+        if self.pos < len(self.tokens):
+            raise ValueError(f"Unexpected '{self.tokens[self.pos]}' in query.")
+        return result
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def _take(self):
+        token = self._peek()
+        if token is None:
+            raise ValueError("Incomplete query.")
+        self.pos += 1
+        return token
+
+    def _expr(self):
+        result = self._term()
+        while self._peek() == "|":
+            self._take()
+            result = result | self._term()
+        return result
+
+    def _term(self):
+        result = self._factor()
+        while self._peek() == "&":
+            self._take()
+            result = result & self._factor()
+        return result
+
+    def _factor(self):
+        token = self._take()
+        if token == "!":
+            return self.live & ~self._factor()
+        if token == "(":
+            result = self._expr()
+            if self._take() != ")":
+                raise ValueError("Missing ')' in query.")
+            return result
+        if token in ("&", "|", ")"):
+            raise ValueError(f"Unexpected '{token}' in query.")
+        if token not in self.person_ids:
+            raise ValueError(f"Unknown person '{token}'.")
+        packed = self.bitmaps.get(self.person_ids[token])
+        if packed is None:
+            raise ValueError(f"'{token}' was registered with a different recognition model.")
+        return packed
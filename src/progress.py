@@ -0,0 +1,52 @@
+import threading
+import time
+from collections import deque, namedtuple
+
+from config import PROGRESS_RATE_WINDOW, PROGRESS_SAMPLE_INTERVAL
+
+# rate is photos per second over the recent window; eta is seconds left, or
+# None until a rate is known
+ProgressSnapshot = namedtuple(
+    "ProgressSnapshot", ["processed", "total", "errors", "current_file", "elapsed", "rate", "eta"]
+)
+
+
+class ProgressChannel:
+    """Collects a scan's progress events for readers that poll.
+
+    Pass `update` as the scanner's progress_callback: each call only
+    overwrites the latest counts, and a (time, processed) sample goes into
+    a ring buffer at most every `sample_interval` seconds. Readers call
+    `snapshot` at their own pace, so their cost does not depend on how
+    fast photos are processed. The rate and ETA cover the last
+    `window` samples, so they follow the current speed.
+    """
+
+    def __init__(self, window=PROGRESS_RATE_WINDOW, sample_interval=PROGRESS_SAMPLE_INTERVAL):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+        self._sample_interval = sample_interval
+        self._started = time.monotonic()
+        self._latest = (0, 0, 0, None)  # processed, total, errors, current_file
+
+    def update(self, processed, total, errors, current_file):
+        now = time.monotonic()
+        with self._lock:
+            self._latest = (processed, total, errors, current_file)
+            if not self._samples or now - self._samples[-1][0] >= self._sample_interval:
+                self._samples.append((now, processed))
+
+    def snapshot(self):
+        """The latest counts with rate and ETA, or None before the first event."""
+        now = time.monotonic()
+        with self._lock:
+            if not self._samples:
+                return None
+            processed, total, errors, current_file = self._latest
+            first_time, first_processed = self._samples[0]
+
+        # Measured up to now, so the rate falls off while the scan is paused
+        span = now - first_time
+        rate = (processed - first_processed) / span if span > 0 and processed > first_processed else 0.0
+        eta = (total - processed) / rate if rate > 0 else None
+        return ProgressSnapshot(processed, total, errors, current_file, now - self._started, rate, eta)
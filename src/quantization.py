@@ -0,0 +1,151 @@
+import numpy as np
+
+EMBEDDING_DIM = 512
+FORMATS = ("float32", "float16", "int8")
+
+# Rows converted to float32 at a time when scoring a compressed matrix
+_CHUNK_ROWS = 65536
+
+
+def _check_format(fmt):
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown embedding format: {fmt!r} (expected one of {FORMATS})")
+
+
+def encode(embedding, fmt):
+    """Serialize one embedding to the on-disk representation of `fmt`.
+
+    int8 blobs carry a float32 scale followed by 512 signed codes.
+    """
+    _check_format(fmt)
+    emb = np.asarray(embedding, dtype=np.float32)
+    if fmt == "float32":
+        return emb.tobytes()
+    if fmt == "float16":
+        return emb.astype(np.float16).tobytes()
+
+    peak = float(np.max(np.abs(emb))) if emb.size else 0.0
+    scale = peak / 127.0 if peak > 0 else 1.0
+    codes = np.clip(np.rint(emb / scale), -127, 127).astype(np.int8)
+    return np.float32(scale).tobytes() + codes.tobytes()
+
+
+def decode(blob, fmt):
+    """Inverse of `encode`, always returning a float32 vector."""
+    _check_format(fmt)
+    if fmt == "float32":
+        return np.frombuffer(blob, dtype=np.float32)
+    if fmt == "float16":
+        return np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+
+    scale = np.frombuffer(blob[:4], dtype=np.float32)[0]
+    codes = np.frombuffer(blob[4:], dtype=np.int8)
+    return codes.astype(np.float32) * scale
+
+
+class EmbeddingMatrix:
+    """Face embeddings kept in their stored (possibly compressed) format.
+
+    float16 matrices take half the memory of float32 and int8 matrices about
+    a quarter. Scoring converts fixed-size chunks to float32 on the fly, so
+    the full-precision matrix is never materialized.
+    """
+
+    def __init__(self, fmt, codes, scales=None, face_ids=None, full_loader=None):
+        _check_format(fmt)
+        self.fmt = fmt
+        self.codes = codes
+        self.scales = scales
+        # Optional: face ids per row and a callable(face_ids) returning the
+        # float32 originals (or None), used for exact rescoring
+        self.face_ids = face_ids
+        self.full_loader = full_loader
+
+    @classmethod
+    def from_blobs(cls, blobs, fmt, face_ids=None, full_loader=None):
+        _check_format(fmt)
+        if not blobs:
+            return cls.empty(fmt)
+
+        n = len(blobs)
+        raw = b"".join(blobs)
+        if fmt == "float32":
+            codes = np.frombuffer(raw, dtype=np.float32).reshape(n, EMBEDDING_DIM)
+            return cls(fmt, codes, face_ids=face_ids)
+        if fmt == "float16":
+            codes = np.frombuffer(raw, dtype=np.float16).reshape(n, EMBEDDING_DIM)
+            return cls(fmt, codes, face_ids=face_ids, full_loader=full_loader)
+
+        packed = np.frombuffer(raw, dtype=np.uint8).reshape(n, 4 + EMBEDDING_DIM)
+        scales = packed[:, :4].copy().view(np.float32).ravel()
+        codes = packed[:, 4:].view(np.int8)
+        return cls(fmt, codes, scales, face_ids=face_ids, full_loader=full_loader)
+
+    @classmethod
+    def empty(cls, fmt="float32"):
+        dtype = {"float32": np.float32, "float16": np.float16, "int8": np.int8}[fmt]
+        scales = np.empty(0, dtype=np.float32) if fmt == "int8" else None
+        return cls(fmt, np.empty((0, EMBEDDING_DIM), dtype=dtype), scales)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def is_compressed(self):
+        return self.fmt != "float32"
+
+    @property
+    def nbytes(self):
+        size = self.codes.nbytes
+        if self.scales is not None:
+            size += self.scales.nbytes
+        return size
+
+    def rows(self, indices):
+        """Return the selected rows dequantized to float32."""
+        rows = self.codes[indices].astype(np.float32)
+        if self.scales is not None:
+            rows *= self.scales[indices][:, None]
+        return rows
+
+    def approx_distances(self, query):
+        """Euclidean distances between unit vectors, scored on the codes.
+
+        For int8 the query is quantized as well, so the score reflects the
+        error of both sides; callers rescore near-threshold rows with
+        `exact_distances`.
+        """
+        query = _unit(np.asarray(query, dtype=np.float32))
+        if self.fmt == "int8":
+            query = decode(encode(query, "int8"), "int8")
+        elif self.fmt == "float16":
+            query = query.astype(np.float16).astype(np.float32)
+        query = _unit(query)
+
+        out = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), _CHUNK_ROWS):
+            stop = min(start + _CHUNK_ROWS, len(self))
+            chunk = self.rows(slice(start, stop))
+            norms = np.maximum(np.linalg.norm(chunk, axis=1), 1e-10)
+            out[start:stop] = (chunk @ query) / norms
+        return np.sqrt(np.maximum(2.0 - 2.0 * out, 0.0))
+
+    def exact_distances(self, query, indices):
+        """Full-precision distances between `query` and the selected rows.
+
+        Uses the float32 originals when a loader is available, otherwise
+        the dequantized rows against the unquantized query.
+        """
+        query = _unit(np.asarray(query, dtype=np.float32))
+        rows = None
+        if self.full_loader is not None and self.face_ids is not None:
+            rows = self.full_loader(self.face_ids[indices])
+        if rows is None:
+            rows = self.rows(indices)
+        rows /= np.maximum(np.linalg.norm(rows, axis=1, keepdims=True), 1e-10)
+        return np.linalg.norm(rows - query, axis=1)
+
+
+def _unit(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
@@ -0,0 +1,66 @@
+from config import RECOGNITION_BATCH_SIZE
+from face_engine import decode_crop
+
+
+class ModelMigration:
+    """Recomputes embeddings from stored face crops after a model change.
+
+    Only the recognition model runs: no image decoding and no detection.
+    New embeddings are written next to the old ones, so searches keep
+    working on the old vectors until `run` swaps them in at the end.
+    Progress is kept in the database, so a cancelled migration resumes
+    where it stopped.
+    """
+
+    def __init__(self, database, engine):
+        self.db = database
+        self.engine = engine
+        self._cancel_requested = False
+
+    @property
+    def needed(self):
+        return self.db.model_version != self.engine.model_version
+
+    def cancel(self):
+        self._cancel_requested = True
+
+    def run(self, progress_callback=None):
+        """Re-embed all stored crops with the engine's model.
+
+        Args:
+            progress_callback: Function(done, total) called after each batch.
+
+        Returns:
+            dict with statistics: faces, persons, stale_photos (dropped for
+            rescanning, no stored crop), persons_without_crops (need to be
+            registered again) and cancelled.
+        """
+        self._cancel_requested = False
+        target = self.engine.model_version
+        stats = {"faces": 0, "persons": 0, "stale_photos": 0, "persons_without_crops": 0, "cancelled": False}
+        batch_size = max(RECOGNITION_BATCH_SIZE, 1) * 4
+
+        done, total = self.db.get_reembed_progress(target)
+        for table in ("persons", "faces"):
+            for rows in self.db.iter_crops_to_reembed(table, target, batch_size):
+                if self._cancel_requested:
+                    stats["cancelled"] = True
+                    return stats
+
+                crops, ids = [], []
+                for row_id, blob in rows:
+                    crop = decode_crop(blob)
+                    if crop is not None:
+                        crops.append(crop)
+                        ids.append(row_id)
+                embeddings = self.engine.embed_crops(crops)
+                self.db.set_next_embeddings(table, zip(ids, embeddings), target)
+                stats[table] += len(ids)
+
+                if table == "faces":
+                    done += len(rows)
+                    if progress_callback:
+                        progress_callback(done, total)
+
+        stats["stale_photos"], stats["persons_without_crops"] = self.db.finish_model_migration(target)
+        return stats
@@ -1,133 +1,319 @@
+import itertools
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from config import VALID_EXTENSIONS, MAX_WORKERS
-from face_engine import FaceEngine
+import zlib
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from config import (
+    VALID_EXTENSIONS, MAX_WORKERS, RELOCATE_SAMPLE_SIZE, RELOCATE_MIN_MATCH,
+    MIN_DET_SCORE, MIN_FACE_SIZE, COARSE_DETECTION, RECOGNITION_BATCH_SIZE, STORE_FACE_CROPS,
+)
+from batching import RecognitionBatcher
+from database import normalize_root
+from face_engine import FaceEngine, encode_crop
+from governor import ResourceGovernor, ScanCancelled
+from listing import stat_files, walk_parallel
+from thumbnails import read_capture_time
+
+
+def in_shard(rel_path, shard):
+    """Whether a photo belongs to shard (index, count) of a library.
+
+    Hashes the path relative to the library root with "/" separators, so
+    every machine splits the library the same way wherever it is mounted.
+    """
+    index, count = shard
+    key = rel_path.replace(os.sep, "/").encode("utf-8", "surrogateescape")
+    return zlib.crc32(key) % count == index
 
 
 class PhotoScanner:
     def __init__(self, database):
         self.db = database
         self.engine = FaceEngine()
+        self.governor = ResourceGovernor()
         self._cancel_requested = False
 
     def cancel(self):
         """Signal the ongoing scan to stop."""
         self._cancel_requested = True
+        self.governor.cancel()
 
     @property
     def is_cancelled(self):
         return self._cancel_requested
 
-    def scan(self, root_path, progress_callback=None):
+    def pause(self):
+        """Hold the ongoing scan after the photos in progress; see resume."""
+        self.governor.pause()
+
+    def resume(self):
+        self.governor.resume()
+
+    @property
+    def is_paused(self):
+        return self.governor.is_paused
+
+    def _checkpoint(self):
+        """Wait while the scan is paused. Returns False once it is cancelled."""
+        try:
+            self.governor.wait_if_paused()
+        except ScanCancelled:
+            return False
+        return not self._cancel_requested
+
+    def _store_face(self, photo_id, face, embedding):
+        crop = encode_crop(face.crop) if STORE_FACE_CROPS and face.crop is not None else None
+        self.db.add_face(
+            photo_id, embedding, face.bbox, face.det_score,
+            crop=crop, model_version=self.engine.model_version,
+        )
+
+    def _store_batched_faces(self, embeddings_future, photo_id, faces):
+        """Store faces whose embeddings came from a recognition batch.
+
+        Returns the number of faces stored, or an error message.
+        """
+        try:
+            embeddings = embeddings_future.result()
+            for face, emb in zip(faces, embeddings):
+                self._store_face(photo_id, face, emb)
+            return len(faces)
+        except Exception as e:
+            return str(e)
+
+    def _drain(self, futures):
+        """Finish the photos still in flight when a scan is cancelled.
+
+        Their photo rows are already written, so their faces must be stored
+        too; otherwise they would stay indexed without faces and never be
+        processed again. Photos not started yet are dropped.
+        """
+        while futures:
+            future, (_, awaiting) = futures.popitem()
+            if future.cancelled():
+                continue
+            if awaiting is not None:
+                self._store_batched_faces(future, *awaiting)
+                continue
+            result = future.result()
+            if isinstance(result, tuple):
+                photo_id, faces, embeddings_future = result
+                futures[embeddings_future] = (None, (photo_id, faces))
+
+    @staticmethod
+    def _capture_time(path):
+        """(taken_at, taken_at_source) of a photo: its EXIF capture time, or
+        (None, "none") without one so date filters leave it out."""
+        try:
+            taken_at = read_capture_time(path)
+        except OSError:
+            taken_at = None
+        return (taken_at, "exif") if taken_at else (None, "none")
+
+    def _matches_sample(self, root, sample):
+        """Fraction of sampled (rel_path, size, mtime) rows found under root."""
+        if not sample:
+            return 0.0
+        hits = 0
+        for rel_path, size, mtime in sample:
+            path = os.path.join(root, rel_path)
+            try:
+                if os.path.getsize(path) == size and int(os.path.getmtime(path)) == mtime:
+                    hits += 1
+            except OSError:
+                pass
+        return hits / len(sample)
+
+    def _resolve_volume(self, root):
+        """Find the volume for root, detecting a library mounted elsewhere.
+
+        Returns (volume_id, previous_root). previous_root is set when an
+        existing volume was relocated to `root`.
+        """
+        volume_id = self.db.get_volume_id(root)
+        if volume_id is not None:
+            return volume_id, None
+
+        for candidate_id, old_root in self.db.get_volumes():
+            sample = self.db.sample_volume_photos(candidate_id, RELOCATE_SAMPLE_SIZE)
+            if self._matches_sample(root, sample) < RELOCATE_MIN_MATCH:
+                continue
+            # Still reachable at the old path: a copy, not a remount
+            if self._matches_sample(old_root, sample) >= RELOCATE_MIN_MATCH:
+                continue
+            self.db.relocate_volume(candidate_id, root)
+            return candidate_id, old_root
+
+        return self.db.add_volume(root), None
+
+    def scan(self, root_path, progress_callback=None, shard=None):
         """Scan root directory detecting new, moved, and removed photos.
 
         Args:
             root_path: Path to the root directory.
             progress_callback: Function(processed, total, errors, current_file)
                 called after each photo is processed.
+            shard: Optional (index, count); only photos in that shard of the
+                library (see in_shard) are listed and indexed.
 
         Returns:
-            dict with statistics: new, moved, removed, errors, cancelled.
+            dict with statistics: new, moved, removed, errors, cancelled,
+            relocated (previous root of a remounted library, or None) and
+            unavailable (root looked unmounted; nothing was changed).
         """
         self._cancel_requested = False
-        stats = {"new": 0, "moved": 0, "removed": 0, "errors": 0, "cancelled": False, "faces_found": 0, "photos_with_faces": 0}
+        self.governor.reset()
+        stats = {"new": 0, "moved": 0, "removed": 0, "errors": 0, "cancelled": False, "faces_found": 0, "photos_with_faces": 0,
+                 "relocated": None, "unavailable": False}
 
-        # 1. List all photos on disk
-        all_files = []
-        for root, _, files in os.walk(root_path):
-            if self._cancel_requested:
-                stats["cancelled"] = True
-                return stats
-            for file in files:
-                if file.lower().endswith(VALID_EXTENSIONS):
-                    all_files.append(os.path.join(root, file))
+        root_path = normalize_root(root_path)
+        volume_id, stats["relocated"] = self._resolve_volume(root_path)
+        # Photos indexed under another volume's (parent or child) root
+        self.db.adopt_photos(volume_id, root_path)
 
-        current_paths = set(all_files)
+        self.engine.reset_coarse_stats()
+        self.db.begin_scan()
+        try:
+            self._scan_volume(root_path, volume_id, stats, progress_callback, shard)
+        finally:
+            self.db.end_scan()
 
-        # 2. Get already indexed photos
-        existing = {path: (size, mtime) for path, size, mtime in self.db.get_all_photos()}
-        existing_paths = set(existing.keys())
+        if COARSE_DETECTION:
+            stats["coarse"] = self.engine.coarse_report()
+        return stats
 
-        # 3. Detect removed and moved photos
-        missing_paths = existing_paths - current_paths
-        candidate_new = current_paths - existing_paths
+    def _scan_volume(self, root_path, volume_id, stats, progress_callback, shard=None):
+        # 1. Stream the listing of photos on disk into the scan table,
+        # directory by directory as the parallel walk reads them
+        def listing():
+            for root, files in walk_parallel(root_path, should_stop=lambda: not self._checkpoint()):
+                for file in files:
+                    if file.lower().endswith(VALID_EXTENSIONS):
+                        path = os.path.join(root, file)
+                        rel_path = os.path.relpath(path, root_path)
+                        if shard is None or in_shard(rel_path, shard):
+                            yield path, rel_path
 
-        # Build fingerprint index of "removed" photos to detect moved ones
-        missing_fingerprints = {}
-        for path in missing_paths:
-            size, mtime = existing[path]
-            key = (size, mtime)
-            missing_fingerprints[key] = path
+        self.db.add_scan_files(listing())
+        if self._cancel_requested:
+            stats["cancelled"] = True
+            return stats
 
-        # Try to match new with removed by fingerprint (size + mtime)
-        truly_new = []
-        moved_mappings = []  # (old_path, new_path)
+        # 2. An empty listing for a non-empty volume is an unmounted drive
+        # (bare mount point), not a library whose photos were all deleted
+        if self.db.count_scan_files() == 0 and self.db.get_photo_count(volume_id):
+            stats["unavailable"] = True
+            return stats
 
-        for new_path in candidate_new:
-            if self._cancel_requested:
+        # 3. Fingerprint (size + mtime) the files that match no indexed path
+        for batch in self.db.iter_unindexed_scan_files():
+            if not self._checkpoint():
                 stats["cancelled"] = True
                 return stats
-            try:
-                size = os.path.getsize(new_path)
-                mtime = int(os.path.getmtime(new_path))
-                key = (size, mtime)
-                if key in missing_fingerprints:
-                    old_path = missing_fingerprints.pop(key)
-                    moved_mappings.append((old_path, new_path))
-                else:
-                    truly_new.append(new_path)
-            except OSError:
-                truly_new.append(new_path)
+            # Files that cannot be stat'ed get no fingerprint: treated as new
+            self.db.set_scan_file_stats(stat_files(batch))
 
-        # 4. Apply move mappings
-        for old_path, new_path in moved_mappings:
-            self.db.update_photo_path(old_path, new_path)
-            stats["moved"] += 1
+        # 4. Match them with unlisted photos to detect moves
+        stats["moved"] = self.db.apply_scan_moves(volume_id)
 
         # 5. Remove photos that are truly gone (not moved)
-        still_missing = set(missing_fingerprints.values())
-        if still_missing:
-            self.db.remove_missing_photos(current_paths)
-            stats["removed"] = len(still_missing)
+        stats["removed"] = self.db.remove_unlisted_photos(volume_id)
 
-        # 6. Process new photos
-        total = len(truly_new)
+        # 6. Record capture times of photos indexed before they were kept
+        for batch in self.db.iter_photos_without_capture_time(volume_id):
+            if not self._checkpoint():
+                stats["cancelled"] = True
+                return stats
+            self.db.set_capture_times(
+                [(*self._capture_time(path), photo_id) for photo_id, path in batch]
+            )
+
+        # 7. Process new photos
+        total = self.db.count_unindexed_scan_files()
         processed = 0
 
+        batcher = RecognitionBatcher(self.engine, governor=self.governor) if RECOGNITION_BATCH_SIZE > 1 else None
+
         def process(path):
-            """Process a single photo: extract metadata and embeddings."""
+            """Process a single photo: extract metadata and embeddings.
+
+            With batching, returns (photo_id, faces, future) once the faces
+            are detected; their embeddings arrive later through the future.
+            Waits for the governor's I/O budget and a CPU slot first, so a
+            pause or cancel stops it before the photo is recorded.
+            """
             try:
-                size = os.path.getsize(path)
-                mtime = int(os.path.getmtime(path))
-                photo_id = self.db.add_photo(path, size, mtime)
-
-                embeddings = self.engine.extract_embeddings(path)
-                for emb in embeddings:
-                    self.db.add_face(photo_id, emb)
-                return len(embeddings)  # Number of faces found
+                st = os.stat(path)
+                size, mtime = st.st_size, int(st.st_mtime)
+                rel_path = os.path.relpath(path, root_path)
+                self.governor.throttle_io(size)
+
+                options = dict(min_det_score=MIN_DET_SCORE, min_face_size=MIN_FACE_SIZE, coarse=COARSE_DETECTION)
+                with self.governor.slot():
+                    taken_at, taken_at_source = self._capture_time(path)
+                    photo_id = self.db.add_photo(path, size, mtime, volume_id, rel_path, taken_at, taken_at_source)
+
+                    if batcher is not None:
+                        faces = self.engine.detect_faces(path, **options)
+                        if faces:
+                            return photo_id, faces, batcher.submit([face.crop for face in faces])
+                        return 0
+
+                    faces = self.engine.extract_faces(path, **options)
+                    for face in faces:
+                        self._store_face(photo_id, face, face.embedding)
+                    return len(faces)  # Number of faces found
             except Exception as e:
                 return str(e)
 
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = {executor.submit(process, path): path for path in truly_new}
-            for future in as_completed(futures):
-                if self._cancel_requested:
-                    executor.shutdown(wait=False, cancel_futures=True)
-                    stats["cancelled"] = True
-                    return stats
-
-                processed += 1
-                result = future.result()
-                if isinstance(result, int):
-                    if result > 0:
-                        stats["faces_found"] += result
-                        stats["photos_with_faces"] += 1
-                else:
-                    stats["errors"] += 1
-
-                if progress_callback:
-                    current_file = futures[future]
-                    progress_callback(processed, total, stats["errors"], current_file)
+        # New paths are read from the scan table lazily and only a bounded
+        # number of photos is in flight, so memory does not grow with the
+        # library. Photos waiting for a recognition batch count as in flight.
+        new_paths = (path for batch in self.db.iter_unindexed_scan_files() for path in batch)
+        max_in_flight = MAX_WORKERS * 4 + (2 * RECOGNITION_BATCH_SIZE if batcher else 0)
+
+        try:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                # future -> (path, (photo_id, faces) while awaiting embeddings)
+                futures = {}
+                for path in itertools.islice(new_paths, max_in_flight):
+                    futures[executor.submit(process, path)] = (path, None)
+
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if self._cancel_requested:
+                            executor.shutdown(wait=False, cancel_futures=True)
+                            self._drain(futures)
+                            stats["cancelled"] = True
+                            return stats
+
+                        current_file, awaiting = futures.pop(future)
+                        if awaiting is None:
+                            result = future.result()
+                            if isinstance(result, tuple):
+                                photo_id, faces, embeddings_future = result
+                                futures[embeddings_future] = (current_file, (photo_id, faces))
+                                continue
+                        else:
+                            result = self._store_batched_faces(future, *awaiting)
+
+                        processed += 1
+                        if isinstance(result, int):
+                            if result > 0:
+                                stats["faces_found"] += result
+                                stats["photos_with_faces"] += 1
+                        else:
+                            stats["errors"] += 1
+
+                        if progress_callback:
+                            progress_callback(processed, total, stats["errors"], current_file)
+
+                        for path in itertools.islice(new_paths, 1):
+                            futures[executor.submit(process, path)] = (path, None)
+        finally:
+            if batcher is not None:
+                batcher.close()
+                stats["recognition_batches"] = dict(batcher.stats)
 
         stats["new"] = total - stats["errors"]
         return stats
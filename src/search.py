@@ -0,0 +1,171 @@
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from config import (
+    FACE_DISTANCE_THRESHOLD, SEARCH_CHUNK_SIZE, SEARCH_MIN_DET_SCORE, SEARCH_MIN_FACE_SIZE,
+    SEARCH_CACHE_MB,
+)
+
+_DATE_PREFIX = re.compile(r"\d{4}(-\d{2}(-\d{2})?)?")
+
+
+def parse_date_bound(text):
+    """Validate a "YYYY", "YYYY-MM" or "YYYY-MM-DD" date filter.
+
+    Returns the stripped text, or None when empty. Raises ValueError for
+    anything else.
+    """
+    text = (text or "").strip()
+    if not text:
+        return None
+    if not _DATE_PREFIX.fullmatch(text):
+        raise ValueError(f"Invalid date '{text}'. Use YYYY, YYYY-MM or YYYY-MM-DD.")
+    return text
+
+
+def search_faces(db, engine, query_embedding, threshold=FACE_DISTANCE_THRESHOLD,
+                 chunk_size=SEARCH_CHUNK_SIZE, min_det_score=SEARCH_MIN_DET_SCORE,
+                 min_face_size=SEARCH_MIN_FACE_SIZE, taken_from=None, taken_to=None,
+                 folder=None, on_progress=None, should_stop=None):
+    """Stream the face index in chunks and collect matching photos.
+
+    Each chunk is scored and merged into a running best distance per photo,
+    so memory is bounded by the chunk size and results can be shown as
+    they arrive. Date and folder filters are applied in the database, so
+    only faces of matching photos are read and scored.
+
+    Args:
+        taken_from, taken_to: Inclusive capture date bounds (see
+            parse_date_bound), e.g. "2019" and "2019" for the whole year.
+        folder: Only photos anywhere under this folder.
+        on_progress: Function(updated, scanned, total) called after each
+            chunk. `updated` maps the paths of photos whose best distance
+            was set or improved by that chunk to their new distance.
+            scanned / total is the fraction of the index searched. Without
+            photo filters they are positions in the face id range, which
+            is free to read where counting all faces is not.
+        should_stop: Function() returning True to abandon the search.
+
+    Returns:
+        SearchResult with every photo closer than `threshold`, with exact
+        distances even for compressed embeddings.
+    """
+    filters = dict(min_det_score=min_det_score, min_face_size=min_face_size,
+                   taken_from=taken_from, taken_to=taken_to, folder=folder)
+    id_range = None
+    if taken_from or taken_to or folder:
+        # Counted through the photo indexes: the cost follows the subset
+        total = db.count_faces(**filters)
+    else:
+        id_range = db.get_face_id_range()
+        total = id_range[1] - id_range[0] + 1 if id_range else 0
+    best = {}  # photo_id -> distance
+    scanned = 0
+
+    for embeddings, paths, photo_ids in db.iter_face_chunks(chunk_size, **filters):
+        if should_stop and should_stop():
+            break
+
+        # Results are cut at lower thresholds later (slider, cache), so every
+        # match needs an exact distance, not only those near `threshold`
+        distances = engine.compare(query_embedding, embeddings, threshold, exact_matches=True)
+        updated = {}
+        for i in np.flatnonzero(distances < threshold):
+            photo_id = int(photo_ids[i])
+            d = float(distances[i])
+            if photo_id not in best or d < best[photo_id]:
+                best[photo_id] = d
+                updated[paths[i]] = d
+
+        if id_range is None:
+            scanned += len(paths)
+        else:
+            # Faces added while searching lie past the range read at the start
+            scanned = min(total, int(embeddings.face_ids[-1]) - id_range[0] + 1)
+        if on_progress:
+            on_progress(updated, scanned, total)
+
+    return SearchResult.from_best(best)
+
+
+class SearchResult:
+    """Best face distance per photo, sorted by distance.
+
+    The photos within any threshold up to the one searched with are a
+    prefix of the arrays, found with a binary search.
+    """
+
+    def __init__(self, distances, photo_ids):
+        self.distances = distances
+        self.photo_ids = photo_ids
+
+    @classmethod
+    def from_best(cls, best):
+        photo_ids = np.fromiter(best.keys(), dtype=np.int64, count=len(best))
+        distances = np.fromiter(best.values(), dtype=np.float32, count=len(best))
+        order = np.argsort(distances, kind="stable")
+        return cls(distances[order], photo_ids[order])
+
+    @classmethod
+    def from_faces(cls, distances, photo_ids):
+        """Build from per-face matches, keeping each photo's best distance."""
+        order = np.lexsort((distances, photo_ids))
+        photo_ids, distances = photo_ids[order], distances[order]
+        first = np.ones(len(photo_ids), dtype=bool)
+        first[1:] = photo_ids[1:] != photo_ids[:-1]
+        photo_ids, distances = photo_ids[first], distances[first].astype(np.float32)
+        order = np.argsort(distances, kind="stable")
+        return cls(distances[order], photo_ids[order])
+
+    def __len__(self):
+        return len(self.photo_ids)
+
+    @property
+    def nbytes(self):
+        return self.distances.nbytes + self.photo_ids.nbytes
+
+    def count(self, threshold):
+        """Number of photos closer than `threshold`."""
+        return int(np.searchsorted(self.distances, threshold, side="left"))
+
+    def within(self, threshold):
+        """(distances, photo_ids) of the photos closer than `threshold`."""
+        n = self.count(threshold)
+        return self.distances[:n], self.photo_ids[:n]
+
+
+class SearchCache:
+    """Recent search results, evicting the least recently used ones once
+    their arrays take more than `max_bytes`.
+
+    Keys should include the index generation, so results are never served
+    after a scan or model migration changed the index.
+    """
+
+    def __init__(self, max_bytes=SEARCH_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            if result.nbytes > self.max_bytes:
+                return
+            self._entries[key] = result
+            self._bytes += result.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
@@ -0,0 +1,374 @@
+"""Headless search server: keeps the face index in memory and answers
+searches, registrations and scans over a local HTTP/JSON API.
+
+Usage:
+    python src/server.py [port]
+
+Endpoints (JSON request bodies and responses):
+    GET  /stats      request counters, latency and throughput per endpoint
+    GET  /persons    registered persons
+    POST /search     {"person", "threshold"?, "taken_from"?, "taken_to"?, "folder"?}
+    POST /query      {"expression"}, e.g. "Alice & !Bob" (see person_index.py)
+    POST /register   {"name", "image_path"}; the image must show one face
+    POST /scan       {"root"}; starts a scan in the background
+    GET  /scan       progress of the running or last scan, with rate and ETA
+    POST /scan/pause, /scan/resume   hold or continue the running scan
+
+The server listens on SERVER_HOST (localhost by default) and has no
+authentication; do not expose it to other machines.
+"""
+import json
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from config import (
+    FACE_DISTANCE_THRESHOLD, SEARCH_CHUNK_SIZE, SEARCH_MAX_THRESHOLD, SEARCH_MIN_DET_SCORE,
+    SEARCH_MIN_FACE_SIZE, SERVER_HOST, SERVER_PORT,
+)
+from database import Database
+from face_engine import encode_crop
+from person_index import PersonIndex
+from progress import ProgressChannel
+from reembed import ModelMigration
+from scanner import PhotoScanner
+from search import SearchCache, SearchResult, parse_date_bound, search_faces
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Metrics:
+    """Per-endpoint request counts, latency percentiles and throughput.
+
+    Percentiles cover the last `window` requests. Throughput counts every
+    request of the last minute in one-second buckets, so it is not capped
+    by the latency window.
+    """
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._endpoints = {}
+        self._window = window
+
+    def record(self, endpoint, seconds, ok):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._endpoints.setdefault(endpoint, {
+                "count": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0,
+                "recent": deque(maxlen=self._window),
+                "per_second": deque(),  # [second, requests] of the last minute
+            })
+            entry["count"] += 1
+            entry["errors"] += 0 if ok else 1
+            entry["total_time"] += seconds
+            entry["max_time"] = max(entry["max_time"], seconds)
+            entry["recent"].append(seconds)
+            second = int(now)
+            buckets = entry["per_second"]
+            if buckets and buckets[-1][0] == second:
+                buckets[-1][1] += 1
+            else:
+                buckets.append([second, 1])
+            while buckets[0][0] <= second - 60:
+                buckets.popleft()
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            report = {"uptime_s": round(now - self._started, 1), "endpoints": {}}
+            for endpoint, entry in self._endpoints.items():
+                recent = np.array(entry["recent"]) * 1000
+                last_minute = sum(n for second, n in entry["per_second"] if second > int(now) - 60)
+                report["endpoints"][endpoint] = {
+                    "count": entry["count"],
+                    "errors": entry["errors"],
+                    "mean_ms": round(entry["total_time"] * 1000 / entry["count"], 2),
+                    "p50_ms": round(float(np.percentile(recent, 50)), 2),
+                    "p95_ms": round(float(np.percentile(recent, 95)), 2),
+                    "max_ms": round(entry["max_time"] * 1000, 2),
+                    "requests_per_s": round(last_minute / min(60.0, max(now - self._started, 1e-6)), 2),
+                }
+            return report
+
+
+class ResidentIndex:
+    """All searchable faces held in memory, reloaded after the index changes.
+
+    Loaded in SEARCH_CHUNK_SIZE pieces in the stored embedding format, so
+    compressed indexes stay compressed in memory.
+    """
+
+    def __init__(self, database, engine):
+        self.db = database
+        self.engine = engine
+        self._lock = threading.Lock()
+        self._chunks = []  # (EmbeddingMatrix, photo_ids)
+        self._state = None  # (index generation, model version)
+
+    def _ensure_loaded(self):
+        state = (self.db.get_index_generation(), self.db.model_version)
+        with self._lock:
+            if state != self._state:
+                self._chunks = [
+                    (embeddings, photo_ids)
+                    for embeddings, _, photo_ids in self.db.iter_face_chunks(
+                        SEARCH_CHUNK_SIZE, min_det_score=SEARCH_MIN_DET_SCORE,
+                        min_face_size=SEARCH_MIN_FACE_SIZE,
+                    )
+                ]
+                self._state = state
+            return self._chunks
+
+    @property
+    def face_count(self):
+        return sum(len(photo_ids) for _, photo_ids in self._ensure_loaded())
+
+    def search(self, query_embedding, threshold):
+        """SearchResult with every photo closer than `threshold`."""
+        distances, photo_ids = [], []
+        for embeddings, chunk_photo_ids in self._ensure_loaded():
+            d = self.engine.compare(query_embedding, embeddings, threshold, exact_matches=True)
+            mask = d < threshold
+            distances.append(d[mask])
+            photo_ids.append(chunk_photo_ids[mask])
+        if not distances:
+            return SearchResult.from_best({})
+        return SearchResult.from_faces(np.concatenate(distances), np.concatenate(photo_ids))
+
+
+class SearchService:
+    """The operations behind the API, on one database and one engine."""
+
+    def __init__(self, database, scanner):
+        self.db = database
+        self.scanner = scanner
+        self.engine = scanner.engine
+        self.index = ResidentIndex(database, self.engine)
+        self.person_index = PersonIndex(database, self.engine)
+        self.cache = SearchCache()
+        self._scan_lock = threading.Lock()
+        self.scan_status = {"running": False}
+        self._scan_progress = None
+
+    def _person_id(self, name):
+        for person_id, person_name in self.db.get_persons():
+            if person_name == name:
+                return person_id
+        raise ApiError(404, f"Unknown person '{name}'")
+
+    def persons(self):
+        return [{"id": person_id, "name": name} for person_id, name in self.db.get_persons()]
+
+    def search(self, body):
+        person_id = self._person_id(body.get("person"))
+        try:
+            threshold = float(body.get("threshold", FACE_DISTANCE_THRESHOLD))
+        except (TypeError, ValueError):
+            raise ApiError(400, "threshold must be a number")
+        if threshold > SEARCH_MAX_THRESHOLD:
+            raise ApiError(400, f"threshold must be at most {SEARCH_MAX_THRESHOLD}")
+        try:
+            filters = dict(
+                taken_from=parse_date_bound(body.get("taken_from")),
+                taken_to=parse_date_bound(body.get("taken_to")),
+                folder=body.get("folder") or None,
+            )
+        except ValueError as e:
+            raise ApiError(400, str(e))
+        if self.db.get_person_model_version(person_id) != self.db.model_version:
+            raise ApiError(409, "Person was registered with a different recognition model")
+
+        key = (person_id, self.db.get_index_generation(), self.db.model_version,
+               tuple(sorted(filters.items())))
+        result = self.cache.get(key)
+        if result is None:
+            query = self.db.get_person_embedding(person_id)
+            if any(filters.values()):
+                # Filtered searches read only the matching faces from disk
+                result = search_faces(self.db, self.engine, query, threshold=SEARCH_MAX_THRESHOLD, **filters)
+            else:
+                result = self.index.search(query, SEARCH_MAX_THRESHOLD)
+            self.cache.put(key, result)
+
+        distances, photo_ids = result.within(threshold)
+        paths = self.db.get_photo_paths(photo_ids)
+        return {
+            "threshold": threshold,
+            "results": [
+                {"path": paths[i], "distance": round(float(d), 4)}
+                for i, d in zip(photo_ids.tolist(), distances) if i in paths
+            ],
+        }
+
+    def query(self, body):
+        person_ids = {name: person_id for person_id, name in self.db.get_persons()}
+        try:
+            paths = self.person_index.query(body.get("expression") or "", person_ids)
+        except ValueError as e:
+            raise ApiError(400, str(e))
+        return {"results": paths}
+
+    def register(self, body):
+        name = (body.get("name") or "").strip()
+        image_path = body.get("image_path")
+        if not name or not image_path:
+            raise ApiError(400, "name and image_path are required")
+        if self.db.model_version != self.engine.model_version:
+            raise ApiError(409, "The face index is being updated for a new recognition model")
+
+        faces = self.engine.extract_faces(image_path)
+        if len(faces) != 1:
+            raise ApiError(400, f"{len(faces)} faces detected; the image must contain exactly 1 face")
+        try:
+            self.db.add_person(
+                name, faces[0].embedding,
+                crop=encode_crop(faces[0].crop), model_version=self.engine.model_version,
+            )
+        except sqlite3.IntegrityError:
+            raise ApiError(409, f"A person named '{name}' already exists")
+        threading.Thread(target=self.person_index.refresh, daemon=True).start()
+        return {"name": name}
+
+    def start_scan(self, body):
+        root = body.get("root")
+        if not root:
+            raise ApiError(400, "root is required")
+        if not self._scan_lock.acquire(blocking=False):
+            raise ApiError(409, "A scan is already running")
+
+        self.scan_status = {"running": True, "paused": False, "root": root}
+        self._scan_progress = progress = ProgressChannel()
+
+        def task():
+            try:
+                stats = self.scanner.scan(root, progress.update)
+                self.person_index.refresh()
+                self.scan_status.update(running=False, stats=stats)
+            except Exception as e:
+                self.scan_status.update(running=False, error=str(e))
+            finally:
+                self._scan_lock.release()
+
+        threading.Thread(target=task, daemon=True).start()
+        return self.scan_state()
+
+    def scan_state(self):
+        state = dict(self.scan_status, processed=0, total=0, errors=0)
+        snapshot = self._scan_progress.snapshot() if self._scan_progress else None
+        if snapshot is not None:
+            state.update(
+                processed=snapshot.processed, total=snapshot.total, errors=snapshot.errors,
+                current_file=snapshot.current_file, photos_per_s=round(snapshot.rate, 2),
+                eta_s=round(snapshot.eta) if snapshot.eta is not None else None,
+            )
+        return state
+
+    def pause_scan(self, paused):
+        if not self.scan_status.get("running"):
+            raise ApiError(409, "No scan is running")
+        if paused:
+            self.scanner.pause()
+        else:
+            self.scanner.resume()
+        self.scan_status["paused"] = paused
+        return self.scan_state()
+
+
+def make_handler(service, metrics):
+    routes = {
+        ("GET", "/stats"): lambda body: {
+            **metrics.snapshot(),
+            "photos": service.db.get_photo_count(),
+            "faces": service.index.face_count,
+            "persons": service.db.get_person_count(),
+        },
+        ("GET", "/persons"): lambda body: service.persons(),
+        ("POST", "/search"): service.search,
+        ("POST", "/query"): service.query,
+        ("POST", "/register"): service.register,
+        ("POST", "/scan"): service.start_scan,
+        ("GET", "/scan"): lambda body: service.scan_state(),
+        ("POST", "/scan/pause"): lambda body: service.pause_scan(True),
+        ("POST", "/scan/resume"): lambda body: service.pause_scan(False),
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        def _handle(self, method):
+            start = time.perf_counter()
+            path = self.path.split("?", 1)[0]
+            route = routes.get((method, path))
+            try:
+                if route is None:
+                    raise ApiError(404, f"No endpoint {method} {path}")
+                body = {}
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    try:
+                        body = json.loads(self.rfile.read(length))
+                    except ValueError:
+                        raise ApiError(400, "Request body is not valid JSON")
+                    if not isinstance(body, dict):
+                        raise ApiError(400, "Request body must be a JSON object")
+                status, payload = 200, route(body)
+            except ApiError as e:
+                status, payload = e.status, {"error": str(e)}
+            except Exception as e:
+                status, payload = 500, {"error": str(e)}
+
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            if route is not None:
+                metrics.record(f"{method} {path}", time.perf_counter() - start, status < 400)
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_POST(self):
+            self._handle("POST")
+
+        def log_message(self, format, *args):
+            pass  # Requests are counted in /stats instead
+
+    return Handler
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else SERVER_PORT
+
+    db = Database()
+    scanner = PhotoScanner(db)
+    db.init_model_version(scanner.engine.model_version)
+    migration = ModelMigration(db, scanner.engine)
+    if migration.needed:
+        print("Updating the face index for the new recognition model...")
+        migration.run(lambda done, total: print(f"  {done:,}/{total:,}", flush=True))
+
+    service = SearchService(db, scanner)
+    print(f"Loading {service.index.face_count:,} faces...")
+    service.person_index.refresh()
+
+    server = ThreadingHTTPServer((SERVER_HOST, port), make_handler(service, Metrics()))
+    print(f"Serving on http://{SERVER_HOST}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
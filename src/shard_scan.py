@@ -0,0 +1,84 @@
+"""Split the first scan of a large library across processes or machines.
+
+Usage:
+    python src/shard_scan.py scan <photo_dir> <index> <count> <shard.db>
+    python src/shard_scan.py merge [--root <photo_dir>] <shard.db> [<shard.db> ...]
+
+`scan` indexes shard `index` (0 to count - 1) of the library into its own
+database file, without the GUI. Photos are split by a hash of their path
+relative to `photo_dir`, so every machine picks the same shards wherever the
+library is mounted. Running it again on the same shard file resumes an
+interrupted shard.
+
+`merge` folds shard files into database.db; photos and faces get new ids
+there. Pass --root when the library is mounted here at another path than
+where the shards were scanned. Shards must be built with the same
+recognition model and EMBEDDING_FORMAT as the main index.
+"""
+import os
+import sys
+import time
+
+from config import DATABASE_PATH
+from database import Database
+from progress import ProgressChannel
+from scanner import PhotoScanner
+
+
+def scan_shard(photo_dir, index, count, shard_path):
+    if not 0 <= index < count:
+        raise ValueError(f"Shard index must be between 0 and {count - 1}")
+    if os.path.abspath(shard_path) == os.path.abspath(DATABASE_PATH):
+        # A shard scan drops photos outside its shard from the database
+        raise ValueError("Write shards to their own file, not the main database")
+
+    db = Database(shard_path)
+    scanner = PhotoScanner(db)
+    db.init_model_version(scanner.engine.model_version)
+
+    start = time.time()
+    last_report = 0.0
+    channel = ProgressChannel()
+
+    def progress(processed, total, errors, current_file):
+        nonlocal last_report
+        channel.update(processed, total, errors, current_file)
+        now = time.time()
+        if now - last_report >= 5 or processed == total:
+            last_report = now
+            snapshot = channel.snapshot()
+            eta = f", {snapshot.eta / 60:.0f} min left" if snapshot.eta is not None else ""
+            print(f"  {processed:,}/{total:,} photos ({snapshot.rate:.1f}/s, {errors} errors{eta})", flush=True)
+
+    print(f"Scanning shard {index}/{count} of {photo_dir} into {shard_path}")
+    stats = scanner.scan(photo_dir, progress, shard=(index, count))
+    print(f"Done in {time.time() - start:.0f}s: {stats['new']:,} new photos, "
+          f"{stats['faces_found']:,} faces, {stats['errors']} errors")
+    return stats
+
+
+def merge_shards(shard_paths, root=None):
+    db = Database()
+    for path in shard_paths:
+        photos, faces = db.merge_shard(path, root)
+        print(f"{path}: {photos:,} photos, {faces:,} faces merged")
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) == 5 and args[0] == "scan":
+        scan_shard(args[1], int(args[2]), int(args[3]), args[4])
+        return
+    if len(args) >= 2 and args[0] == "merge":
+        root = None
+        paths = args[1:]
+        if paths[0] == "--root" and len(paths) >= 3:
+            root, paths = paths[1], paths[2:]
+        merge_shards(paths, root)
+        return
+    print(__doc__)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import re
+import struct
+
+import cv2
+import numpy as np
+
+# The EXIF segment (APP1) is at most 64 KB and sits at the start of the file
+_HEADER_BYTES = 128 * 1024
+
+_TAG_ORIENTATION = 0x0112
+_TAG_DATETIME = 0x0132
+_TAG_EXIF_IFD = 0x8769
+_TAG_DATETIME_ORIGINAL = 0x9003
+_TAG_THUMB_OFFSET = 0x0201
+_TAG_THUMB_LENGTH = 0x0202
+
+# EXIF orientation -> rotation that makes the image upright. Mirrored
+# variants are mapped to their rotation; a flip does not matter for detection.
+_ROTATIONS = {
+    3: cv2.ROTATE_180,
+    4: cv2.ROTATE_180,
+    5: cv2.ROTATE_90_CLOCKWISE,
+    6: cv2.ROTATE_90_CLOCKWISE,
+    7: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    8: cv2.ROTATE_90_COUNTERCLOCKWISE,
+}
+
+
+def _read_ifd(tiff, offset, endian):
+    """Returns ({tag: (type, count, raw_value)}, next_ifd_offset)."""
+    if offset <= 0 or offset + 2 > len(tiff):
+        return {}, 0
+    (count,) = struct.unpack_from(endian + "H", tiff, offset)
+    entries = {}
+    pos = offset + 2
+    for _ in range(count):
+        if pos + 12 > len(tiff):
+            return entries, 0
+        tag, typ, n = struct.unpack_from(endian + "HHI", tiff, pos)
+        entries[tag] = (typ, n, tiff[pos + 8:pos + 12])
+        pos += 12
+    next_offset = 0
+    if pos + 4 <= len(tiff):
+        (next_offset,) = struct.unpack_from(endian + "I", tiff, pos)
+    return entries, next_offset
+
+
+def _int_value(entry, endian):
+    typ, _, raw = entry
+    if typ == 3:  # SHORT
+        return struct.unpack_from(endian + "H", raw)[0]
+    return struct.unpack_from(endian + "I", raw)[0]
+
+
+def _read_exif_tiff(path):
+    """Return (tiff_bytes, endian) of a JPEG's EXIF segment, or (None, None).
+
+    Only the file header is read.
+    """
+    with open(path, "rb") as f:
+        head = f.read(_HEADER_BYTES)
+    if head[:2] != b"\xff\xd8":
+        return None, None
+
+    pos = 2
+    while pos + 4 <= len(head) and head[pos] == 0xFF:
+        marker = head[pos + 1]
+        if marker == 0xDA:  # Start of scan: no more metadata
+            break
+        (seg_len,) = struct.unpack_from(">H", head, pos + 2)
+        if marker == 0xE1 and head[pos + 4:pos + 10] == b"Exif\x00\x00":
+            tiff = head[pos + 10:pos + 2 + seg_len]
+            if len(tiff) < 8:
+                break
+            if tiff[:2] == b"II":
+                return tiff, "<"
+            if tiff[:2] == b"MM":
+                return tiff, ">"
+            break
+        pos += 2 + seg_len
+    return None, None
+
+
+def read_exif_thumbnail(path):
+    """Return (jpeg_bytes, orientation) of a JPEG's embedded EXIF thumbnail.
+
+    Only the file header is read. Returns (None, 1) when the file has no
+    EXIF thumbnail or is not a JPEG.
+    """
+    tiff, endian = _read_exif_tiff(path)
+    if tiff is None:
+        return None, 1
+    return _parse_tiff_thumbnail(tiff, endian)
+
+
+def _parse_tiff_thumbnail(tiff, endian):
+    (ifd0_offset,) = struct.unpack_from(endian + "I", tiff, 4)
+    ifd0, ifd1_offset = _read_ifd(tiff, ifd0_offset, endian)
+    orientation = 1
+    if _TAG_ORIENTATION in ifd0:
+        orientation = _int_value(ifd0[_TAG_ORIENTATION], endian)
+
+    ifd1, _ = _read_ifd(tiff, ifd1_offset, endian)
+    if _TAG_THUMB_OFFSET not in ifd1 or _TAG_THUMB_LENGTH not in ifd1:
+        return None, orientation
+    start = _int_value(ifd1[_TAG_THUMB_OFFSET], endian)
+    length = _int_value(ifd1[_TAG_THUMB_LENGTH], endian)
+    if length <= 0 or start + length > len(tiff):
+        return None, orientation
+    return tiff[start:start + length], orientation
+
+
+def _ascii_value(tiff, entry, endian):
+    typ, count, raw = entry
+    if typ != 2:  # ASCII
+        return None
+    if count <= 4:
+        data = raw[:count]
+    else:
+        (offset,) = struct.unpack_from(endian + "I", raw)
+        data = tiff[offset:offset + count]
+    return data.split(b"\x00", 1)[0].decode("ascii", "replace")
+
+
+_EXIF_DATETIME = re.compile(r"(\d{4}):(\d{2}):(\d{2}) (\d{2}:\d{2}:\d{2})")
+
+
+def read_capture_time(path):
+    """Return when a JPEG was taken as "YYYY-MM-DD HH:MM:SS", or None.
+
+    Reads DateTimeOriginal, falling back to the IFD0 DateTime. EXIF times
+    are local camera time without a time zone and are returned as such.
+    Only the file header is read.
+    """
+    tiff, endian = _read_exif_tiff(path)
+    if tiff is None:
+        return None
+
+    (ifd0_offset,) = struct.unpack_from(endian + "I", tiff, 4)
+    ifd0, _ = _read_ifd(tiff, ifd0_offset, endian)
+    candidates = []
+    if _TAG_EXIF_IFD in ifd0:
+        exif_ifd, _ = _read_ifd(tiff, _int_value(ifd0[_TAG_EXIF_IFD], endian), endian)
+        if _TAG_DATETIME_ORIGINAL in exif_ifd:
+            candidates.append(exif_ifd[_TAG_DATETIME_ORIGINAL])
+    if _TAG_DATETIME in ifd0:
+        candidates.append(ifd0[_TAG_DATETIME])
+
+    for entry in candidates:
+        match = _EXIF_DATETIME.match(_ascii_value(tiff, entry, endian) or "")
+        # Unset dates are written as "0000:00:00 00:00:00"
+        if match and match.group(1) != "0000":
+            return "{}-{}-{} {}".format(*match.groups())
+    return None
+
+
+def load_preview(path):
+    """Load a small, upright version of an image for a cheap first look.
+
+    Uses the embedded EXIF thumbnail when there is one, otherwise decodes
+    the image at 1/8 scale (JPEG DCT scaling, much cheaper than a full
+    decode). Returns (img, source) with source "exif" or "reduced", or
+    (None, None) if nothing could be decoded.
+    """
+    try:
+        jpeg, orientation = read_exif_thumbnail(path)
+    except OSError:
+        jpeg, orientation = None, 1
+
+    if jpeg:
+        img = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is not None:
+            if orientation in _ROTATIONS:
+                img = cv2.rotate(img, _ROTATIONS[orientation])
+            return img, "exif"
+
+    img = cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_8)
+    if img is not None:
+        return img, "reduced"
+    return None, None
@@ -0,0 +1,87 @@
+"""Shared fixtures. Tests run without the recognition models: face_engine
+is replaced by a stub that finds one face in every photo."""
+import os
+import sys
+import threading
+import time
+import types
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from quantization import EMBEDDING_DIM  # noqa: E402
+
+DetectedFace = namedtuple("DetectedFace", ["embedding", "bbox", "det_score", "crop"])
+
+
+class StubEngine:
+    """One face per photo with a fixed embedding. Counts the photos it was
+    asked to detect faces in; `delay` slows detection down so a scan can be
+    cancelled part way through."""
+
+    model_version = "stub"
+    delay = 0.0
+
+    def __init__(self):
+        self.detected = []
+        self._lock = threading.Lock()
+
+    def reset_coarse_stats(self):
+        pass
+
+    def coarse_report(self):
+        return {}
+
+    def _detect(self, path):
+        time.sleep(self.delay)
+        with self._lock:
+            self.detected.append(path)
+
+    def extract_faces(self, path, **options):
+        self._detect(path)
+        return [DetectedFace(_embedding(1), (0, 0, 50, 50), 0.9, None)]
+
+    def detect_faces(self, path, **options):
+        self._detect(path)
+        return [DetectedFace(None, (0, 0, 50, 50), 0.9, np.zeros((112, 112, 3), np.uint8))]
+
+    def embed_crops(self, crops):
+        return _embedding(len(crops))
+
+
+def _embedding(count):
+    return np.full((count, EMBEDDING_DIM), 1 / np.sqrt(EMBEDDING_DIM), dtype=np.float32)
+
+
+_stub = types.ModuleType("face_engine")
+_stub.FaceEngine = StubEngine
+_stub.encode_crop = lambda crop: b""
+sys.modules["face_engine"] = _stub
+
+
+@pytest.fixture
+def db(tmp_path):
+    from database import Database
+
+    database = Database(str(tmp_path / "index.db"))
+    yield database
+    database.conn.close()
+
+
+@pytest.fixture
+def library(tmp_path):
+    """Folder with `photos(count)` helper creating that many small files."""
+    root = tmp_path / "library"
+    root.mkdir()
+
+    def photos(count, folder="", start=0):
+        target = root / folder
+        target.mkdir(parents=True, exist_ok=True)
+        for i in range(start, start + count):
+            (target / f"{i}.jpg").write_bytes(b"x" * (i + 1))
+        return root
+
+    return photos
@@ -0,0 +1,40 @@
+from database import folder_key
+
+ROOT = "/library"
+
+
+def index_photos(db, volume_id, photos):
+    """Insert (rel_path, size, mtime) rows as indexed photos; returns their ids by path."""
+    with db.conn:
+        db.conn.executemany("""
+            INSERT INTO photos (file_path, file_size, last_modified, volume_id, rel_path, folder)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(f"{ROOT}/{rel}", size, mtime, volume_id, rel, folder_key(f"{ROOT}/{rel}"))
+              for rel, size, mtime in photos])
+    return dict(db.conn.execute("SELECT rel_path, id FROM photos").fetchall())
+
+
+def list_files(db, files):
+    """Record (rel_path, size, mtime) as the files found by a scan."""
+    db.add_scan_files((f"{ROOT}/{rel}", rel) for rel, _, _ in files)
+    db.set_scan_file_stats([(size, mtime, f"{ROOT}/{rel}") for rel, size, mtime in files])
+
+
+def test_moves_match_same_names_before_fingerprints(db):
+    volume_id = db.add_volume(ROOT)
+    # Pairs of burst shots share a fingerprint; the second of each pair is
+    # also renamed, so only the first can be matched by name
+    old = [(f"old/{i}.jpg", 1000 + i // 2, 1600000000) for i in range(200)]
+    ids = index_photos(db, volume_id, old)
+    new = [
+        (f"new/{i % 7}/{i if i % 2 == 0 else f'renamed-{i}'}.jpg", size, mtime)
+        for i, (_, size, mtime) in enumerate(old)
+    ]
+
+    db.begin_scan()
+    list_files(db, new)
+    assert db.apply_scan_moves(volume_id) == 200
+    db.end_scan()
+
+    moved = dict(db.conn.execute("SELECT rel_path, id FROM photos").fetchall())
+    assert moved == {new_rel: ids[old_rel] for (old_rel, _, _), (new_rel, _, _) in zip(old, new)}
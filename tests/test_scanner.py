@@ -0,0 +1,49 @@
+import os
+
+from scanner import PhotoScanner
+
+
+def face_count(db):
+    return db.conn.execute("SELECT COUNT(*) FROM faces").fetchone()[0]
+
+
+def test_cancelled_scan_keeps_faces_of_recorded_photos(db, library):
+    root = library(400)
+    scanner = PhotoScanner(db)
+    scanner.engine.delay = 0.002
+
+    def cancel_at_100(processed, total, errors, current_file):
+        if processed == 100:
+            scanner.cancel()
+
+    stats = scanner.scan(str(root), cancel_at_100)
+    assert stats["cancelled"]
+    # Photos in flight when the scan stopped are recorded with their faces
+    assert face_count(db) == db.get_photo_count() < 400
+
+    stats = scanner.scan(str(root))
+    assert not stats["cancelled"]
+    assert db.get_photo_count() == 400
+    assert face_count(db) == 400
+
+
+def test_moved_photos_keep_their_records(db, library):
+    root = library(30, "old")
+    scanner = PhotoScanner(db)
+    scanner.scan(str(root))
+    ids = dict(db.conn.execute("SELECT rel_path, id FROM photos").fetchall())
+
+    (root / "new").mkdir()
+    for i in range(30):
+        # os.rename keeps size and mtime, the fingerprint moves are matched by
+        (root / "old" / f"{i}.jpg").rename(root / "new" / f"{i % 3}-{i}.jpg")
+    detected = len(scanner.engine.detected)
+
+    stats = scanner.scan(str(root))
+    assert (stats["moved"], stats["new"], stats["removed"]) == (30, 0, 0)
+    assert len(scanner.engine.detected) == detected
+    moved = dict(db.conn.execute("SELECT rel_path, id FROM photos").fetchall())
+    assert moved == {
+        os.path.join("new", f"{i % 3}-{i}.jpg"): ids[os.path.join("old", f"{i}.jpg")] for i in range(30)
+    }
+    assert face_count(db) == 30